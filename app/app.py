@@ -1,399 +1,406 @@
-import logging
-import os
-import re
-import urllib.parse
-
-import pandas as pd
-from flask import (Flask, Response, redirect, render_template, request,
-                   send_from_directory, url_for)
-from flask_bootstrap import Bootstrap
-from flask_login import (LoginManager, UserMixin, current_user, login_required,
-                         login_user, logout_user)
-from flask_sqlalchemy import SQLAlchemy
-from flask_wtf import FlaskForm
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
-from wtforms import BooleanField, PasswordField, StringField
-from wtforms.validators import Email, InputRequired, Length
-
-import pyodbc
-from functions import *
-from parameters import (database, dbo_table, driver, label_mapping, password,
-                        server, username)
-
-# DATABASE URI: 
-params = urllib.parse.quote_plus("DRIVER={};SERVER={};DATABASE={};UID={};PWD={}".format(
-        driver, server, database, username, password
-    )
-)
-
-# FLASK APP INIT
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'supersecret'
-app.config['SQLALCHEMY_DATABASE_URI'] = "mssql+pyodbc:///?odbc_connect=%s" % params
-app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
-
-# FLASK APP EXTENSIONS
-db = SQLAlchemy(app)
-login_manager = LoginManager()
-login_manager.init_app(app)
-bootstrap = Bootstrap(app)
-login_manager.login_view = 'login'
-
-# USER CLASS DEFINITION
-class Users(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(15), unique=True)
-    email = db.Column(db.String(50), unique=True)
-    password = db.Column(db.String(80))
-
-@login_manager.user_loader
-def load_user(user_id):
-    return Users.query.get(int(user_id))
-
-# FLASK FORM CLASSES
-class LoginForm(FlaskForm):
-    username = StringField('Username', validators=[InputRequired(), Length(min=4, max=15)])
-    password = PasswordField('Password', validators=[InputRequired(), Length(min=8, max=80)])
-    remember = BooleanField('Remember Me')
-
-class NewPwdForm(FlaskForm):
-    password = PasswordField('Old Password', validators=[InputRequired(), Length(min=8, max=80)])
-    new_pwd = PasswordField('New Password', validators=[InputRequired(), Length(min=8, max=80)])
-    new_pwd_confirmation = PasswordField('New Password Confirmation', validators=[InputRequired(), Length(min=8, max=80)])
-
-class RegisterForm(FlaskForm):
-    email = StringField('Email', validators=[InputRequired(), Email(message='Invalid Email'), Length(max=50)])
-    username = StringField('Username', validators=[InputRequired(), Length(min=4, max=15)])
-    password = PasswordField('Password', validators=[InputRequired(), Length(min=8, max=80)])
-
-# LOGGING SETUP   
-logging.basicConfig(filename='logfile.txt', level = logging.INFO)
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger('werkzeug').setLevel(logging.WARNING)
-logging.getLogger('PIL.PngImagePlugin').setLevel(logging.WARNING)
-
-# GLOBAL VARIABLES
-UPLOAD_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/uploads/"
-DOWNLOAD_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/downloads/"
-ML_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
-
-# ROUTES
-@app.route("/", methods = ["GET", "POST"])
-def start():
-    return redirect("/home")
-
-@app.route("/home", methods = ["GET", "POST"])
-@login_required
-def home():
-    return render_template("home.html", name=current_user.username)
-
-@app.route('/login', methods = ["GET", "POST"])
-def login():
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        try:
-            user = Users.query.filter_by(username=form.username.data).first()
-            if user:
-                if check_password_hash(user.password, form.password.data):
-                    login_user(user, remember=form.remember.data)
-                    return redirect(url_for('home'))
-
-            return render_template('signin.html', form=form, err = "Invalid username or password")
-        
-        except Exception as e:
-            logging.critical("The following error occured when logging in: {}".format(str(e)))
-            return render_template('signin.html', form=form, err = "An error has occured. See logs for details.")
-
-    return render_template('signin.html', form=form)
-
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
-
-@app.route('/signup', methods=['GET', 'POST'])
-def signup():
-    form = RegisterForm()
-
-    if form.validate_on_submit():
-        try:
-            return render_template('signup.html', form=form, err = "Feature disabled for demo purposes")
-            #hashed_password = generate_password_hash(form.password.data, method='sha256')
-            #new_user = Users(username=form.username.data, email=form.email.data, password=hashed_password)
-            #db.session.add(new_user)
-            #db.session.commit()
-            #return render_template('signup.html', form=form, err = "New user has been created!")
-        
-        except Exception as e:
-            logging.critical("The following error occured when signing up: {}".format(str(e)))
-            return render_template('signup.html', form=form, err = "An error has occured. See logs for details.")
-
-    return render_template('signup.html', form=form)
-
-@app.route('/account', methods=['GET', 'POST'])
-@login_required
-def update_pwd():
-    form = NewPwdForm()
-
-    if form.validate_on_submit():
-
-        try:
-            user = Users.query.filter_by(username=current_user.username).first()
-            if user:
-                if check_password_hash(user.password, form.password.data):
-                    if form.new_pwd.data == form.new_pwd_confirmation.data:
-                        return render_template('newpwd.html', form=form, err = "Feature disabled for demo purposes")
-                        #hashed_password = generate_password_hash(form.new_pwd.data, method='sha256')
-                        #user.password = hashed_password
-                        #db.session.commit()
-                        #return render_template('newpwd.html', form=form, err = "Password successfully updated!")
-                    else:
-                        return render_template('newpwd.html', form=form, err = "Password confirmation does not match")
-        
-        except Exception as e:
-            logging.critical("The following error occured when changing password: {}".format(str(e)))
-            return render_template('newpwd.html', form=form, err = "An error has occured. See logs for details.")
-                
-        return render_template('newpwd.html', form=form, err = "Invalid username or password")
-
-    return render_template('newpwd.html', form=form, err = "")
-
-@app.route("/spendingview", methods = ["GET", "POST"])
-@login_required
-def spendingview():
-    return render_template("pbi_chartspending.html")
-
-@app.route("/incomeview", methods = ["GET", "POST"])
-@login_required
-def incomeview():
-    return render_template("pbi_chartincome.html")
-
-@app.route("/tableview", methods = ["GET", "POST"])
-@login_required
-def tableview():
-    return render_template("pbi_tableview.html")
-
-@app.route("/upload", methods = ["GET", "POST"])
-@login_required
-def upload():
-    
-    try:
-        clean_uploadfolder(UPLOAD_FOLDER)
-    except Exception as e:
-        logging.debug("Error when cleaning up upload folder {}".format(str(e)))
-
-    if request.method == 'POST':
-        if 'file' in request.files:
-            file = request.files['file']
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-
-                if filename.split(".")[1].lower() == "pdf":
-                    if not re.match('^[0-9]{8}$',filename[-12:].split(".")[0]):
-                        logging.critical("Invalid pdf name. Expected the following structure: RELEVES_MR SURNAME FIRSTNAME_20140220.pdf")
-                        return render_template("upload.html", stage = "fileselection")
-                    pdf_path = os.path.join(UPLOAD_FOLDER, filename)
-                    file.save(pdf_path)
-                    return render_template("upload.html", stage = "pdfprocessing")
-
-                elif filename.split(".")[1].lower() == "xlsx":
-                    excel_path = os.path.join(UPLOAD_FOLDER, filename)
-                    file.save(excel_path)
-                    logging.info("Excel file uploaded")
-                    try:
-                        # Write to Output table Excel
-                        df = pd.read_excel(excel_path)
-                        writer = pd.ExcelWriter(UPLOAD_FOLDER + "/output_table.xlsx")
-                        df.to_excel(writer, 'Sheet1', index=False)
-                        writer.save()
-                        return render_template("upload.html", dataframe = df.to_html(classes="jumbotron_table"), stage = "dfview")
-                    except Exception as e:
-                        logging.critical("Error occured when processing xlsx file: {}".format(str(e)))
-
-    return render_template("upload.html", stage = "fileselection") 
-
-@app.route('/upload/<path:filename>', methods=['GET', 'POST'])
-@login_required
-def download_excelouput(filename):
-    try:
-        return send_from_directory(directory=UPLOAD_FOLDER, filename=filename, as_attachment=True)
-    except Exception as e:
-        logging.critical("Exception when downloading file: {}".format(str(e)))
-        return render_template("upload.html", stage = "fileselection")
-
-@app.route('/download/<path:filename>', methods=['GET', 'POST'])
-@login_required
-def download_sample(filename):
-    try:
-        return send_from_directory(directory=DOWNLOAD_FOLDER, filename=filename, as_attachment=True)
-    except Exception as e:
-        logging.critical("Exception when downloading file: {}".format(str(e)))
-        return render_template("upload.html", stage = "fileselection")
-
-@app.route('/dfview', methods=['GET', 'POST'])
-@login_required
-def dfview():
-    outputfilepath = UPLOAD_FOLDER + "/" + "output_table.xlsx"
-    df = pd.read_excel(outputfilepath, encoding="utf-8")
-
-    return render_template("upload.html", dataframe = df.to_html(classes="jumbotron_table"), stage="dfview")
-
-@app.route('/updateconfirmation', methods=['GET', 'POST'])
-@login_required
-def updateconfirmation():
-    outputfilepath = UPLOAD_FOLDER + "/" + "output_table.xlsx"
-    df = pd.read_excel(outputfilepath, encoding="utf-8")
-
-    return render_template("upload.html", dataframe = df.to_html(classes="jumbotron_table"), stage = "updateconfirmation")
-    
-@app.route('/updatingdb', methods=['GET', 'POST'])
-@login_required
-def updatingdb():
-    outputfilepath = UPLOAD_FOLDER + "/" + "output_table.xlsx"
-    df = pd.read_excel(outputfilepath, encoding="utf-8")
-
-    return render_template("upload.html", dataframe = df.to_html(classes="jumbotron_table"), stage = "updatingdb")
-
-@app.route('/progress_pdfprocessing')
-@login_required
-def progress_pdfprocessing():
-    def generate():
-        logging.info("Starting...")
-        try:
-            for file_path in os.listdir(UPLOAD_FOLDER):
-                if file_path.endswith(".pdf"):
-                    pdf_path = UPLOAD_FOLDER + "/" + file_path
-                    logging.info("pdf path: {}".format(pdf_path))
-        except Exception as e:
-            logging.critical("Pdf path could not be found : {}".format(str(e)))
-            return render_template("upload.html", stage = "uploadfailure")
-
-        try:
-            # Takes a pdf path and save extracted text to text files in the UPLOAD folder
-            images = pdf_to_images(pdf_path, UPLOAD_FOLDER)
-
-            progress = 0
-            int_progress = 0
-            total_loop_count = len(images) + 1
-            last_step = 100
-            step = float(last_step / total_loop_count)
-            counter = 0
-            ocr_text = ""
-            progress += step
-            int_progress = int(progress)
-            yield "data:" + str(int_progress) + "\n\n"
-
-            logging.info("Processed 0/{} page(s)...".format(len(images)))
-            for image in images:
-                counter += 1
-                ocr_text = ocr_text + "\n" + read_image(image)
-
-                int_progress = int(progress)
-                if int_progress <= last_step:
-                    yield "data:" + str(int_progress) + "\n\n"
-                    logging.info("Processed {}/{} page(s)...".format(str(counter), len(images)))
-                    progress += step
-
-                os.remove(image)
-
-            with open(UPLOAD_FOLDER + os.path.basename(pdf_path).split(".")[0] + ".txt", "w", encoding="utf-8") as text_file:
-                text_file.write(ocr_text)
-        except Exception as e:
-            logging.critical("Error occurred while atempting to convert pdf to txt : {}".format(str(e)))
-
-        try:
-            df = text_to_df(UPLOAD_FOLDER, ML_FOLDER)
-        except Exception as e:
-            logging.critical("Error occurred while atempting to generate df from txt : {}".format(str(e)))
-
-        try:
-            # Write to Excel
-            writer = pd.ExcelWriter(UPLOAD_FOLDER + "/output_table.xlsx")
-            df.to_excel(writer, 'Sheet1', index=False)
-            writer.save()
-            logging.info("Pdf file saved")
-        except Exception as e:
-            logging.critical("Error occurred while atempting to save df as .xlsx : {}".format(str(e)))
-
-        int_progress = 100
-        yield "data:" + str(int_progress) + "\n\n"
-
-    return Response(generate(), mimetype= 'text/event-stream')
-
-@app.route('/progress_updatingdb')
-@login_required
-def progress_updatingdb():
-    def generate():
-        progress = 0
-        int_progress = 0
-        succeeded = 0
-        failed = 0
-
-        try:
-            outputfilepath = UPLOAD_FOLDER + "/" + "output_table.xlsx"
-            df = pd.read_excel(outputfilepath, encoding="utf-8")
-            total_rows = int(df.shape[0]) - 1
-            last_step = 100
-            step = float(last_step / total_rows)
-            print(str(step))
-
-            logging.info("Connecting to DB")
-            cnxn = pyodbc.connect('DRIVER={};SERVER={};PORT=1433;DATABASE={};UID={};PWD={}'.format(
-                    driver, server, database, username, password
-                )
-            )
-
-            cursor = cnxn.cursor()
-        except Exception as e:
-            logging.critical("Could not connect to database : {}".format(str(e)))
-            return render_template("upload.html", stage = "uploadfailure")
-
-        for index, row in df.iterrows():
-            try:
-                qStr = "INSERT INTO {}([ID],[Date],[Value],[Category],[Reference]) VALUES ('{}','{}','{}','{}','{}')".format(
-                    dbo_table, str(row['ID']), row['Date'], row['Value'],row['Category'],row['Reference']
-                    )
-                cursor.execute(qStr)
-                cnxn.commit()
-                succeeded += 1
-            except Exception as e:
-                logging.debug("SQL Insert failed: {}".format(str(e)))
-                failed += 1
-            finally:
-                if index == total_rows:
-                    progress = last_step
-                int_progress = int(progress)
-                if int_progress <= last_step:
-                    yield "data:" + str(int_progress) + "\n\n"
-                    progress += step
-
-        logging.info("Closing DB connection")
-        cursor.close()
-        cnxn.close()
-
-        logging.info("{} successful transactions.".format(str(succeeded)))
-        logging.info("{} failed transactions.".format(str(failed)))
-
-        # save number of failed/succeeded SQL transations
-        with open(UPLOAD_FOLDER + "/sql_results.txt", "w") as sql_results:
-            sql_results.write(str(succeeded) + "\n")
-            sql_results.write(str(failed))
-
-    return Response(generate(), mimetype= 'text/event-stream')
-
-@app.route("/success", methods = ["GET", "POST"])
-@login_required
-def success():
-    with open(UPLOAD_FOLDER + "/sql_results.txt") as f:
-        content = f.readlines()
-    content = [x.strip() for x in content]
-
-    return render_template("success.html", success = content[0], failure = content[1])
-
-
-if __name__ == "__main__":
-    app.run(debug=True)
+import hmac
+import logging
+import os
+import re
+
+from flask import (Flask, Response, abort, g, jsonify, redirect,
+                   render_template, request, send_from_directory, url_for)
+from flask_bootstrap import Bootstrap
+from flask_login import (LoginManager, UserMixin, current_user, login_required,
+                         login_user, logout_user)
+from flask_sqlalchemy import SQLAlchemy
+from flask_wtf import FlaskForm
+from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.utils import secure_filename
+from wtforms import BooleanField, PasswordField, StringField
+from wtforms.validators import Email, InputRequired, Length
+
+from broker import ProgressBroker
+from jobs import DONE, JobQueue
+from metrics import flush_metrics, render_metrics, save_profile, start_profile
+from parameters import (db_pool_recycle, job_database, label_mapping,
+                        lazy_imports, metrics_token, profile_requests,
+                        workspace_ttl)
+from storage import create_backend
+from workspaces import (allowed_file, clean_workspaces, create_workspace,
+                        get_workspace)
+
+# Pandas, scikit-learn and the OCR modules (functions.py, batch.py) are imported by the routes that use them,
+# so that workers boot quickly and pages such as /login never load them, unless lazy_imports is turned off
+if not lazy_imports:
+    import batch, functions, loader
+
+# STORAGE BACKEND: Azure SQL (mssql) or local SQLite file, see parameters.py
+# Its connection pool is shared by every request of the worker
+storage = create_backend()
+
+# FLASK APP INIT
+app = Flask(__name__)
+app.config['SECRET_KEY'] = 'supersecret'
+app.config['SQLALCHEMY_DATABASE_URI'] = storage.sqlalchemy_uri()
+app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+app.config['SQLALCHEMY_POOL_RECYCLE'] = db_pool_recycle
+
+# FLASK APP EXTENSIONS
+db = SQLAlchemy(app)
+login_manager = LoginManager()
+login_manager.init_app(app)
+bootstrap = Bootstrap(app)
+login_manager.login_view = 'login'
+
+# USER CLASS DEFINITION
+class Users(UserMixin, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(15), unique=True)
+    email = db.Column(db.String(50), unique=True)
+    password = db.Column(db.String(80))
+
+@login_manager.user_loader
+def load_user(user_id):
+    return Users.query.get(int(user_id))
+
+# FLASK FORM CLASSES
+class LoginForm(FlaskForm):
+    username = StringField('Username', validators=[InputRequired(), Length(min=4, max=15)])
+    password = PasswordField('Password', validators=[InputRequired(), Length(min=8, max=80)])
+    remember = BooleanField('Remember Me')
+
+class NewPwdForm(FlaskForm):
+    password = PasswordField('Old Password', validators=[InputRequired(), Length(min=8, max=80)])
+    new_pwd = PasswordField('New Password', validators=[InputRequired(), Length(min=8, max=80)])
+    new_pwd_confirmation = PasswordField('New Password Confirmation', validators=[InputRequired(), Length(min=8, max=80)])
+
+class RegisterForm(FlaskForm):
+    email = StringField('Email', validators=[InputRequired(), Email(message='Invalid Email'), Length(max=50)])
+    username = StringField('Username', validators=[InputRequired(), Length(min=4, max=15)])
+    password = PasswordField('Password', validators=[InputRequired(), Length(min=8, max=80)])
+
+# LOGGING SETUP   
+logging.basicConfig(filename='logfile.txt', level = logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
+logging.getLogger('PIL.PngImagePlugin').setLevel(logging.WARNING)
+
+# GLOBAL VARIABLES
+UPLOAD_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/uploads/"
+DOWNLOAD_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/downloads/"
+ML_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
+PROFILE_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/profiles/"
+
+# Pdf processing and database loads run in the job worker processes (worker.py), web workers only queue jobs
+# and stream their progress to the browser
+jobs = JobQueue(job_database)
+broker = ProgressBroker(jobs)
+
+def user_workspace(workspace_id):
+    """
+    Output: Path of a workspace of the current user, aborts with 404 if it does not exist or has expired
+    """
+    workspace = get_workspace(UPLOAD_FOLDER, workspace_id, current_user.id)
+    if workspace is None:
+        abort(404)
+    return workspace
+
+def user_job(job_id):
+    """
+    Output: State of a job submitted by the current user (see JobQueue.get), aborts with 404 for the jobs of other users
+    """
+    job = jobs.get(job_id)
+    if job is None or jobs.owner(job_id) != current_user.id:
+        abort(404)
+    return job
+
+# PROFILING: requests called with ?profile=1 are profiled when profile_requests is set in parameters.py
+# Streamed responses (progress_*) are only profiled until their generator starts
+@app.before_request
+def start_request_profile():
+    if profile_requests and request.args.get('profile'):
+        g.profiler = start_profile()
+
+@app.after_request
+def save_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        save_profile(profiler, PROFILE_FOLDER, request.endpoint or "request")
+    return response
+
+# METRICS: samples recorded while handling a request are written once, when it ends
+@app.teardown_request
+def save_request_metrics(exception):
+    flush_metrics()
+
+# ROUTES
+@app.route("/", methods = ["GET", "POST"])
+def start():
+    return redirect("/home")
+
+@app.route("/home", methods = ["GET", "POST"])
+@login_required
+def home():
+    return render_template("home.html", name=current_user.username)
+
+@app.route('/login', methods = ["GET", "POST"])
+def login():
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        try:
+            user = Users.query.filter_by(username=form.username.data).first()
+            if user:
+                if check_password_hash(user.password, form.password.data):
+                    login_user(user, remember=form.remember.data)
+                    return redirect(url_for('home'))
+
+            return render_template('signin.html', form=form, err = "Invalid username or password")
+        
+        except Exception as e:
+            logging.critical("The following error occured when logging in: {}".format(str(e)))
+            return render_template('signin.html', form=form, err = "An error has occured. See logs for details.")
+
+    return render_template('signin.html', form=form)
+
+@app.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for('login'))
+
+@app.route('/signup', methods=['GET', 'POST'])
+def signup():
+    form = RegisterForm()
+
+    if form.validate_on_submit():
+        try:
+            return render_template('signup.html', form=form, err = "Feature disabled for demo purposes")
+            #hashed_password = generate_password_hash(form.password.data, method='sha256')
+            #new_user = Users(username=form.username.data, email=form.email.data, password=hashed_password)
+            #db.session.add(new_user)
+            #db.session.commit()
+            #return render_template('signup.html', form=form, err = "New user has been created!")
+        
+        except Exception as e:
+            logging.critical("The following error occured when signing up: {}".format(str(e)))
+            return render_template('signup.html', form=form, err = "An error has occured. See logs for details.")
+
+    return render_template('signup.html', form=form)
+
+@app.route('/account', methods=['GET', 'POST'])
+@login_required
+def update_pwd():
+    form = NewPwdForm()
+
+    if form.validate_on_submit():
+
+        try:
+            user = Users.query.filter_by(username=current_user.username).first()
+            if user:
+                if check_password_hash(user.password, form.password.data):
+                    if form.new_pwd.data == form.new_pwd_confirmation.data:
+                        return render_template('newpwd.html', form=form, err = "Feature disabled for demo purposes")
+                        #hashed_password = generate_password_hash(form.new_pwd.data, method='sha256')
+                        #user.password = hashed_password
+                        #db.session.commit()
+                        #return render_template('newpwd.html', form=form, err = "Password successfully updated!")
+                    else:
+                        return render_template('newpwd.html', form=form, err = "Password confirmation does not match")
+        
+        except Exception as e:
+            logging.critical("The following error occured when changing password: {}".format(str(e)))
+            return render_template('newpwd.html', form=form, err = "An error has occured. See logs for details.")
+                
+        return render_template('newpwd.html', form=form, err = "Invalid username or password")
+
+    return render_template('newpwd.html', form=form, err = "")
+
+@app.route("/spendingview", methods = ["GET", "POST"])
+@login_required
+def spendingview():
+    return render_template("pbi_chartspending.html")
+
+@app.route("/incomeview", methods = ["GET", "POST"])
+@login_required
+def incomeview():
+    return render_template("pbi_chartincome.html")
+
+@app.route("/tableview", methods = ["GET", "POST"])
+@login_required
+def tableview():
+    return render_template("pbi_tableview.html")
+
+@app.route("/aggregates/<by>")
+@login_required
+def aggregates(by):
+    # Spending and income by month or year, or totals by category, served from the monthly rollup table
+    if by not in ("month", "year", "category"):
+        abort(404)
+    year = request.args.get('year', type=int)
+    try:
+        results = storage.aggregate(by, year)
+    except Exception as e:
+        logging.critical("Error occurred while aggregating transactions : {}".format(str(e)))
+        abort(500)
+
+    return jsonify(by = by, year = year, results = results)
+
+@app.route("/upload", methods = ["GET", "POST"])
+@login_required
+def upload():
+    
+    try:
+        clean_workspaces(UPLOAD_FOLDER, workspace_ttl)
+    except Exception as e:
+        logging.debug("Error when cleaning up upload folder {}".format(str(e)))
+
+    if request.method == 'POST':
+        if 'file' in request.files:
+            file = request.files['file']
+            if file and allowed_file(file.filename):
+                filename = secure_filename(file.filename)
+
+                if filename.split(".")[1].lower() == "pdf":
+                    if not re.match('^[0-9]{8}$',filename[-12:].split(".")[0]):
+                        logging.critical("Invalid pdf name. Expected the following structure: RELEVES_MR SURNAME FIRSTNAME_20140220.pdf")
+                        return render_template("upload.html", stage = "fileselection")
+                    workspace_id, workspace = create_workspace(UPLOAD_FOLDER, current_user.id)
+                    pdf_path = os.path.join(workspace, filename)
+                    file.save(pdf_path)
+                    job_id = jobs.submit('statements', {'pdf_paths': [pdf_path], 'workspace': workspace, 'owner': current_user.id})
+                    return render_template("upload.html", stage = "pdfprocessing", job_id = job_id, workspace_id = workspace_id)
+
+                elif filename.split(".")[1].lower() == "zip":
+                    workspace_id, workspace = create_workspace(UPLOAD_FOLDER, current_user.id)
+                    zip_path = os.path.join(workspace, filename)
+                    file.save(zip_path)
+                    try:
+                        from batch import extract_statements
+                        pdf_paths = extract_statements(zip_path, workspace)
+                    except Exception as e:
+                        logging.critical("Error occured when extracting zip file: {}".format(str(e)))
+                        pdf_paths = []
+                    finally:
+                        os.remove(zip_path)
+                    if not pdf_paths:
+                        logging.critical("No valid pdf found in the zip file. Expected the following structure: RELEVES_MR SURNAME FIRSTNAME_20140220.pdf")
+                        return render_template("upload.html", stage = "fileselection")
+                    logging.info("{} pdf file(s) extracted from zip file".format(len(pdf_paths)))
+                    job_id = jobs.submit('statements', {'pdf_paths': sorted(pdf_paths), 'workspace': workspace,
+                                                         'owner': current_user.id})
+                    return render_template("upload.html", stage = "batchprocessing", job_id = job_id, workspace_id = workspace_id)
+
+                elif filename.split(".")[1].lower() == "xlsx":
+                    workspace_id, workspace = create_workspace(UPLOAD_FOLDER, current_user.id)
+                    excel_path = os.path.join(workspace, filename)
+                    file.save(excel_path)
+                    logging.info("Excel file uploaded")
+                    try:
+                        import pandas as pd
+                        from functions import save_table
+
+                        # Parsed once, the next stages read the saved table
+                        df = pd.read_excel(excel_path)
+                        save_table(df, workspace)
+                        return render_template("upload.html", stage = "dfview", workspace_id = workspace_id)
+                    except Exception as e:
+                        logging.critical("Error occured when processing xlsx file: {}".format(str(e)))
+
+    return render_template("upload.html", stage = "fileselection") 
+
+@app.route('/upload/<workspace_id>/<path:filename>', methods=['GET', 'POST'])
+@login_required
+def download_excelouput(workspace_id, filename):
+    workspace = user_workspace(workspace_id)
+    try:
+        from functions import EXCEL_FILE, table_to_excel
+        if filename == EXCEL_FILE:
+            table_to_excel(workspace)
+        return send_from_directory(directory=workspace, filename=filename, as_attachment=True)
+    except Exception as e:
+        logging.critical("Exception when downloading file: {}".format(str(e)))
+        return render_template("upload.html", stage = "fileselection")
+
+@app.route('/download/<path:filename>', methods=['GET', 'POST'])
+@login_required
+def download_sample(filename):
+    try:
+        return send_from_directory(directory=DOWNLOAD_FOLDER, filename=filename, as_attachment=True)
+    except Exception as e:
+        logging.critical("Exception when downloading file: {}".format(str(e)))
+        return render_template("upload.html", stage = "fileselection")
+
+@app.route('/dfview/<workspace_id>', methods=['GET', 'POST'])
+@login_required
+def dfview(workspace_id):
+    user_workspace(workspace_id)
+
+    return render_template("upload.html", stage="dfview", workspace_id = workspace_id)
+
+@app.route('/updateconfirmation/<workspace_id>', methods=['GET', 'POST'])
+@login_required
+def updateconfirmation(workspace_id):
+    user_workspace(workspace_id)
+
+    return render_template("upload.html", stage = "updateconfirmation", workspace_id = workspace_id)
+    
+@app.route('/updatingdb/<workspace_id>', methods=['POST'])
+@login_required
+def updatingdb(workspace_id):
+    workspace = user_workspace(workspace_id)
+    # Submitting the confirmation twice follows the load already pending instead of loading the table again
+    job_id = jobs.submit_once('load', {'workspace': workspace, 'owner': current_user.id})
+
+    return render_template("upload.html", stage = "updatingdb", job_id = job_id, workspace_id = workspace_id)
+
+@app.route('/transactions/<workspace_id>')
+@login_required
+def transactions(workspace_id):
+    # One page of the parsed table, the table view loads pages on demand instead of rendering every row
+    from functions import load_table, table_page, table_records
+    df = load_table(user_workspace(workspace_id))
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+    rows, total = table_page(df, page, per_page, sort = request.args.get('sort'),
+                             descending = request.args.get('order') == 'desc', search = request.args.get('q'))
+
+    return jsonify(columns = [str(column) for column in df.columns], rows = table_records(rows),
+                   total = total, page = page, per_page = per_page, pages = (total + per_page - 1) // per_page)
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = user_job(job_id)
+    return jsonify(status = job['status'], progress = job['progress'])
+
+@app.route('/jobs/<job_id>/events')
+@login_required
+def job_events(job_id):
+    # Progress stream of a job, fed by the worker-wide broker instead of one polling loop per stream
+    user_job(job_id)
+    return Response(broker.stream(job_id), mimetype = 'text/event-stream',
+                    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrape target: processing metrics of every web and job worker, no user data
+    # Only served to the local host, or to scrapers sending the token set in parameters.py
+    token = request.headers.get('Authorization', '')
+    if request.remote_addr not in ('127.0.0.1', '::1') and not (
+            metrics_token and hmac.compare_digest(token.encode(), "Bearer {}".format(metrics_token).encode())):
+        abort(403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/success/<workspace_id>/<job_id>", methods = ["GET", "POST"])
+@login_required
+def success(workspace_id, job_id):
+    user_workspace(workspace_id)
+    job = user_job(job_id)
+    if job['kind'] != 'load' or job['status'] != DONE:
+        abort(404)
+    # Counts returned by the load job, updated/unchanged/duplicates are None unless db_load_mode is 'upsert'
+    result = job['result']
+    return render_template("success.html", success = result['succeeded'], failure = result['failed'], updated = result['updated'],
+                           unchanged = result['unchanged'], duplicates = result['duplicates'])
+
+
+if __name__ == "__main__":
+    app.run(debug=True)
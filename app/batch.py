@@ -0,0 +1,147 @@
+import argparse
+import logging
+import os
+import queue
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from werkzeug.utils import secure_filename
+
+from functions import statement_to_df, statements_to_table
+from ocr import ocr_pdf, pdf_page_count
+from ocr_cache import OCRCache
+from parameters import (batch_workers, ocr_cache_max_bytes, zip_max_member_bytes,
+                        zip_max_total_bytes)
+
+# Statements are named after their date, e.g. RELEVES_MR SURNAME FIRSTNAME_20140220.pdf
+STATEMENT_NAME = re.compile(r'[0-9]{8}\.pdf$', re.IGNORECASE)
+
+
+def extract_statements(zip_path, folder, max_member_bytes=zip_max_member_bytes, max_total_bytes=zip_max_total_bytes):
+    """
+    Extract the pdf statements of a ZIP archive into a folder, ignoring any other member
+    Files are prefixed with their index in the archive, so that statements with the same name in different
+    folders of the archive do not overwrite each other
+    Sizes are checked against the uncompressed sizes of the archive, which the reads never go beyond
+    Output: List of extracted pdf paths, raises ValueError when the statements exceed max_total_bytes
+    """
+    pdf_paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        members = []
+        for member in archive.infolist():
+            filename = secure_filename(os.path.basename(member.filename))
+            if not STATEMENT_NAME.search(filename):
+                logging.warning("Skipping {} from the ZIP archive: not a dated pdf statement".format(member.filename))
+            elif member.file_size > max_member_bytes:
+                logging.warning("Skipping {} from the ZIP archive: {} bytes, more than {}".format(
+                    member.filename, member.file_size, max_member_bytes))
+            else:
+                members.append((member, filename))
+
+        total = sum(member.file_size for member, _ in members)
+        if total > max_total_bytes:
+            raise ValueError("ZIP archive statements are {} bytes uncompressed, more than {}".format(total, max_total_bytes))
+
+        for index, (member, filename) in enumerate(members):
+            pdf_path = os.path.join(folder, "{:04d}_{}".format(index, filename))
+            with archive.open(member) as source, open(pdf_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            pdf_paths.append(pdf_path)
+    return pdf_paths
+
+def find_statements(path, folder):
+    """
+    Input: Folder of pdf statements, ZIP archive of statements, or a single pdf
+    Output: Sorted list of pdf paths, ZIP members being extracted into folder
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, filename) for filename in os.listdir(path) if STATEMENT_NAME.search(filename))
+    if zipfile.is_zipfile(path):
+        return sorted(extract_statements(path, folder))
+    return [path]
+
+def statement_text(pdf_path, cache=None, on_start=None, on_page=None):
+    """
+    Extract the text of every page of one statement
+    on_start(page_count) is called once the page count is known, on_page() each time a page completes
+    Output: Statement text, pages in order
+    """
+    page_count = pdf_page_count(pdf_path)
+    if on_start is not None:
+        on_start(page_count)
+    pages = [""] * page_count
+    for index, text in ocr_pdf(pdf_path, page_count, cache):
+        pages[index] = text
+        if on_page is not None:
+            on_page()
+    return "".join("\n" + text for text in pages)
+
+def ingest_statements(pdf_paths, ML_FOLDER, cache=None, workers=batch_workers, merchants=None):
+    """
+    Process many statements concurrently and merge them into one table
+    Statements run on a thread pool, their pages share the OCR process pool of the worker
+    Output: Generator of (pages done, pages expected, None) progress events, ended by (pages done, pages done, df)
+    Statements that cannot be processed are logged and left out of the table
+    merchants: optional MerchantIndex looked up before the category model
+    """
+    events = queue.Queue()
+
+    def process(pdf_path):
+        try:
+            text = statement_text(pdf_path, cache,
+                                  on_start=lambda page_count: events.put(('start', page_count)),
+                                  on_page=lambda: events.put(('page', 1)))
+            return statement_to_df(text, os.path.basename(pdf_path))
+        except Exception as e:
+            logging.critical("Could not process {} : {}".format(pdf_path, str(e)))
+            return None
+        finally:
+            events.put(('done', 1))
+
+    pages_done = 0
+    # Statements not started yet count as one page until their page count is known
+    pages_expected = len(pdf_paths)
+    statements_done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process, pdf_path) for pdf_path in pdf_paths]
+        while statements_done < len(futures):
+            event, count = events.get()
+            if event == 'start':
+                pages_expected += count - 1
+            elif event == 'page':
+                pages_done += count
+            else:
+                statements_done += 1
+            yield pages_done, max(pages_expected, pages_done, 1), None
+        frames = [future.result() for future in futures if future.result() is not None]
+
+    logging.info("Processed {} of {} statement(s), {} page(s)".format(len(frames), len(pdf_paths), pages_done))
+    yield pages_done, pages_done, statements_to_table(frames, ML_FOLDER, merchants)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract and categorise the transactions of many bank statements")
+    parser.add_argument("path", help="Folder or ZIP archive of pdf statements")
+    parser.add_argument("-o", "--output", default="output_table.xlsx", help="Excel file to write (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=batch_workers, help="Statements processed concurrently")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    app_folder = os.path.dirname(os.path.realpath(__file__))
+    cache = OCRCache(app_folder + "/cache/ocr_cache.db", ocr_cache_max_bytes)
+
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_paths = find_statements(args.path, folder)
+        logging.info("Found {} statement(s)".format(len(pdf_paths)))
+        for done, total, df in ingest_statements(pdf_paths, app_folder + "/ml/", cache, args.workers):
+            if df is None:
+                logging.info("Processed {}/{} page(s)...".format(done, total))
+
+    writer = pd.ExcelWriter(args.output)
+    df.to_excel(writer, 'Sheet1', index=False)
+    writer.save()
+    logging.info("{} transactions written to {}".format(len(df), args.output))
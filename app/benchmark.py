@@ -0,0 +1,309 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import pytesseract
+from pdf2image.exceptions import PDFPageCountError
+
+from classifier import get_registry
+from functions import statement_to_df, statements_to_table
+from merchants import MerchantIndex
+from metrics import flush_metrics, reset_store, set_store
+from ocr import pdf_page_count, rasterise_page, tesseract_config
+from parameters import (db_load_mode, ocr_lang, ocr_max_skew,
+                        sqlite_rollup_table, sqlite_sample_database,
+                        sqlite_table)
+from preprocess import preprocess_page
+from storage import SQLiteBackend
+from synthetic import generate_statements
+
+APP_FOLDER = os.path.dirname(os.path.realpath(__file__))
+ML_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
+BASELINE_FILE = os.path.dirname(os.path.realpath(__file__)) + "/benchmark_baseline.json"
+STAGES = ('rasterise', 'preprocess', 'ocr_raw', 'ocr', 'parse', 'classify', 'load')
+# Tesseract settings of the OCR path without preprocessing, what the 'ocr' stage is compared with
+RAW_OCR = {'lang': 'eng', 'config': ''}
+BOOT_MODES = (('lazy', True), ('eager', False))
+
+# Run by a fresh interpreter: time to import the web app (what a gunicorn worker does when it boots),
+# then to serve a first classification, with the resident memory of the worker after each step
+BOOT_PROBE = """
+import json, resource, sys, time
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            return [int(line.split()[1]) for line in f if line.startswith('VmRSS:')][0] / 1024.0
+    except IOError:
+        # macOS: peak resident memory, in bytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 / 1024.0
+
+start = time.time()
+sys.path.insert(0, {app_folder!r})
+import parameters
+parameters.storage_backend = 'sqlite'
+parameters.sqlite_database = {database!r}
+parameters.metrics_database = {folder!r} + '/metrics.db'
+parameters.job_database = {folder!r} + '/jobs.db'
+parameters.lazy_imports = {lazy!r}
+import app
+result = {{'boot_seconds': time.time() - start, 'boot_rss_mb': rss_mb()}}
+
+start = time.time()
+from classifier import classify_references
+classify_references({references!r}, app.ML_FOLDER)
+result.update(classify_seconds=time.time() - start, classify_rss_mb=rss_mb())
+print(json.dumps(result))
+"""
+
+
+def peak_rss_mb():
+    """
+    Output: Peak resident memory of the benchmark process so far, in MB (child processes such as tesseract excluded)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+def stage_result(seconds, pages, rows, **extra):
+    result = {
+        'seconds': seconds,
+        'pages_per_s': pages / seconds if seconds else 0.0,
+        'rows_per_s': rows / seconds if seconds else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    result.update(extra)
+    return result
+
+def parse_text(text, statement):
+    """
+    Parse a statement text, None if the statement markers are missing (unreadable OCR output)
+    """
+    try:
+        return statement_to_df(text, os.path.basename(statement['text_path']))
+    except ValueError:
+        return None
+
+def ocr_accuracy(texts, statements):
+    """
+    Output: Share of the generated transactions found with the right date and amount in the OCR texts
+    """
+    found = expected = 0
+    for text, statement in zip(texts, statements):
+        truth = Counter((day, cents) for day, cents, _, _ in statement['transactions'])
+        expected += sum(truth.values())
+        df = parse_text(text, statement)
+        if df is None:
+            continue
+        parsed = Counter(zip(df['date'].dt.strftime('%d/%m/%Y'), df['cents'].astype(int)))
+        found += sum((truth & parsed).values())
+    return found / float(expected) if expected else 0.0
+
+def bench_ocr(statements, rows):
+    """
+    Rasterise every page of the generated pdfs, then OCR it as before preprocessing (whole page, RAW_OCR settings)
+    and after preprocessing with the settings of parameters.py, timing each stage separately
+    Output: Dictionary of stage results, stages are left out when poppler or tesseract is not installed
+    """
+    results = {}
+    pages = 0
+    seconds = dict.fromkeys(('rasterise', 'preprocess', 'ocr_raw', 'ocr'), 0.0)
+    texts = {'ocr_raw': [], 'ocr': []}
+    pixels = kept = 0
+    ocr_available = True
+    for statement in statements:
+        page_texts = {'ocr_raw': [], 'ocr': []}
+        try:
+            page_count = pdf_page_count(statement['pdf_path'])
+            for page_number in range(1, page_count + 1):
+                start = time.time()
+                image = rasterise_page(statement['pdf_path'], page_number)
+                seconds['rasterise'] += time.time() - start
+                start = time.time()
+                prepared = preprocess_page(image, ocr_max_skew)
+                seconds['preprocess'] += time.time() - start
+                pixels += image.size[0] * image.size[1]
+                kept += prepared.size[0] * prepared.size[1]
+                pages += 1
+                if not ocr_available:
+                    continue
+                try:
+                    for stage, page, settings in (('ocr_raw', image, RAW_OCR),
+                                                  ('ocr', prepared, {'lang': ocr_lang, 'config': tesseract_config()})):
+                        start = time.time()
+                        page_texts[stage].append(pytesseract.image_to_string(page, **settings))
+                        seconds[stage] += time.time() - start
+                except OSError as e:
+                    logging.warning("OCR stages skipped, tesseract is not available: {}".format(str(e)))
+                    ocr_available = False
+        except (OSError, PDFPageCountError) as e:
+            logging.warning("Rasterise and OCR stages skipped, poppler is not available: {}".format(str(e)))
+            return results
+        for stage, stage_texts in page_texts.items():
+            texts[stage].append("".join("\n" + text for text in stage_texts))
+
+    results['rasterise'] = stage_result(seconds['rasterise'], pages, rows)
+    results['preprocess'] = stage_result(seconds['preprocess'], pages, rows, pixels=kept / float(pixels) if pixels else 0.0)
+    if ocr_available:
+        for stage in ('ocr_raw', 'ocr'):
+            results[stage] = stage_result(seconds[stage], pages, rows, accuracy=ocr_accuracy(texts[stage], statements))
+    return results
+
+def run_benchmark(folder, statements, transactions, seed=0, ocr=True, skew=1.0):
+    """
+    Generate synthetic statements in folder and time each ingest stage on them
+    The scanned pages are rotated by up to skew degrees, like real scans
+    Parsing reads the generated texts, so it does not depend on the OCR quality, and the table is loaded
+    into a copy of the sample transactions database
+    Output: Dictionary of stage results (seconds, pages/s, rows/s, peak RSS in MB)
+    """
+    set_store(os.path.join(folder, "metrics.db"))
+    generated = generate_statements(folder, statements, transactions, ML_FOLDER, seed, pdf=ocr, skew=skew)
+    pages = sum(statement['pages'] for statement in generated)
+    rows = sum(len(statement['transactions']) for statement in generated)
+    results = bench_ocr(generated, rows) if ocr else {}
+
+    texts = []
+    for statement in generated:
+        with open(statement['text_path'], encoding="utf-8") as f:
+            texts.append(f.read())
+    start = time.time()
+    frames = [parse_text(text, statement) for text, statement in zip(texts, generated)]
+    frames = [frame for frame in frames if frame is not None]
+    results['parse'] = stage_result(time.time() - start, pages, rows)
+
+    database = os.path.join(folder, os.path.basename(sqlite_sample_database))
+    shutil.copy(sqlite_sample_database, database)
+    storage = SQLiteBackend(database, sqlite_table, sqlite_rollup_table)
+    merchants = MerchantIndex(lambda: [(reference, category) for _, reference, category in storage.labelled_transactions()])
+
+    # Warm up: the merchant index and the category model are loaded once per worker, not per upload
+    statements_to_table(frames[:1], ML_FOLDER, merchants)
+    start = time.time()
+    df = statements_to_table(frames, ML_FOLDER, merchants)
+    results['classify'] = stage_result(time.time() - start, pages, rows, hit_rate=merchants.metrics()['hit_rate'])
+
+    # Builds the rollup table outside of the timed load
+    storage.aggregate('year')
+    start = time.time()
+    for _ in (storage.upsert_transactions(df) if db_load_mode == 'upsert' else storage.insert_transactions(df)):
+        pass
+    results['load'] = stage_result(time.time() - start, pages, df.shape[0])
+    return results
+
+def bench_boot(folder, references):
+    """
+    Boot a web worker in a fresh interpreter, with lazy then eager imports (lazy_imports in parameters.py)
+    The compiled category model is created first, like in the Docker image
+    Output: Dictionary of boot results (seconds and RSS in MB after boot and after a first classification) by mode
+    """
+    get_registry(ML_FOLDER).get()
+    results = {}
+    for mode, lazy in BOOT_MODES:
+        code = BOOT_PROBE.format(app_folder=APP_FOLDER, database=os.path.join(folder, os.path.basename(sqlite_sample_database)),
+                                 folder=os.path.join(folder, "boot"), lazy=lazy, references=references)
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=folder)
+        results[mode] = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return results
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(path, scenario, results, boot=None):
+    baselines = load_baselines(path)
+    baselines[scenario] = {stage: {'pages_per_s': round(result['pages_per_s'], 2), 'rows_per_s': round(result['rows_per_s'], 2)}
+                           for stage, result in results.items()}
+    if boot:
+        baselines['boot'] = {mode: {name: round(value, 3) for name, value in result.items()} for mode, result in boot.items()}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=4, sort_keys=True)
+
+def compare(results, baseline):
+    """
+    Output: Dictionary of the rows/s change of each stage against the baseline (-0.2 = 20% slower)
+    """
+    return {stage: result['rows_per_s'] / baseline[stage]['rows_per_s'] - 1
+            for stage, result in results.items() if baseline.get(stage, {}).get('rows_per_s')}
+
+def compare_boot(boot, baseline):
+    """
+    Output: Dictionary of the boot speed change of each mode against the baseline (-0.2 = 20% slower)
+    """
+    return {mode: baseline[mode]['boot_seconds'] / result['boot_seconds'] - 1
+            for mode, result in boot.items() if baseline.get(mode, {}).get('boot_seconds')}
+
+def report(results, changes):
+    print("{:<12}{:>10}{:>12}{:>12}{:>10}{:>10}  {}".format("stage", "seconds", "pages/s", "rows/s", "rss MB", "vs base", "notes"))
+    for stage in STAGES:
+        if stage not in results:
+            print("{:<12}{:>10}".format(stage, "skipped"))
+            continue
+        result = results[stage]
+        notes = ", ".join("{} {:.1%}".format(name, result[name]) for name in ('accuracy', 'pixels', 'hit_rate') if name in result)
+        print("{:<12}{:>10.3f}{:>12.1f}{:>12.1f}{:>10.1f}{:>10}  {}".format(
+            stage, result['seconds'], result['pages_per_s'], result['rows_per_s'], result['peak_rss_mb'],
+            "{:+.0%}".format(changes[stage]) if stage in changes else "-", notes))
+
+def report_boot(boot, changes):
+    print("{:<10}{:>10}{:>10}{:>16}{:>10}{:>10}".format("worker", "boot s", "rss MB", "1st classify s", "rss MB", "vs base"))
+    for mode, _ in BOOT_MODES:
+        result = boot[mode]
+        print("{:<10}{:>10.3f}{:>10.1f}{:>16.3f}{:>10.1f}{:>10}".format(
+            mode, result['boot_seconds'], result['boot_rss_mb'], result['classify_seconds'], result['classify_rss_mb'],
+            "{:+.0%}".format(changes[mode]) if mode in changes else "-"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each ingest stage on synthetic statements, offline (SQLite backend)")
+    parser.add_argument("-n", "--statements", type=int, default=12, help="Number of statements")
+    parser.add_argument("-t", "--transactions", type=int, default=100, help="Transactions per statement")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the generator")
+    parser.add_argument("--no-ocr", action="store_true", help="Skip the rasterise and OCR stages")
+    parser.add_argument("--skew", type=float, default=1.0, help="Maximum rotation of the scanned pages, in degrees")
+    parser.add_argument("--no-boot", action="store_true", help="Skip the web worker boot time and memory measures")
+    parser.add_argument("--keep", help="Folder to write the statements and database copy to, kept after the run")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baselines file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline of this size")
+    parser.add_argument("--check", action="store_true", help="Exit with an error if a stage is slower than its baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Slowdown allowed by --check (0.3 = 30%%)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    folder = args.keep or tempfile.mkdtemp(prefix="bsa_benchmark_")
+    try:
+        results = run_benchmark(folder, args.statements, args.transactions, args.seed, not args.no_ocr, args.skew)
+        boot = None if args.no_boot else bench_boot(folder, ["CARREFMARKETDAC", "RETRAIT DAB 0607", "QUICK"])
+    finally:
+        # The benchmark metrics are written to the folder before it is deleted, and none reach the app metrics
+        reset_store()
+        atexit.unregister(flush_metrics)
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    scenario = "{}x{}".format(args.statements, args.transactions)
+    changes = compare(results, load_baselines(args.baseline).get(scenario, {}))
+    print("{} statements x {} transactions".format(args.statements, args.transactions))
+    report(results, changes)
+    if boot:
+        boot_changes = compare_boot(boot, load_baselines(args.baseline).get('boot', {}))
+        print("")
+        report_boot(boot, boot_changes)
+        changes.update(("boot " + mode, change) for mode, change in boot_changes.items())
+
+    if args.save_baseline:
+        save_baseline(args.baseline, scenario, results, boot)
+        print("Baseline {} saved to {}".format(scenario, args.baseline))
+    if args.check and any(change < -args.tolerance for change in changes.values()):
+        sys.exit("Slower than the {} baseline by more than {:.0%}".format(scenario, args.tolerance))
@@ -0,0 +1,95 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from jobs import DONE, FAILED
+from parameters import job_poll_interval, progress_keepalive
+
+
+class ProgressBroker(object):
+    """
+    Fans out the progress of background jobs to every open progress stream of a web worker
+    A single poller reads the state of all the subscribed jobs from the job queue in one query per interval,
+    and puts the changes on the queue of each subscriber. Under the gevent worker class (see entrypoint.py)
+    the poller and the streams are greenlets, so a worker holds hundreds of streams without an OS thread each
+    """
+
+    def __init__(self, jobs, interval=job_poll_interval):
+        self.jobs = jobs
+        self.interval = interval
+        self._lock = threading.Lock()
+        # job id: {subscriber queue: last state put on it}
+        self._subscribers = defaultdict(dict)
+        self._poller = None
+
+    def subscribe(self, job_id):
+        """
+        Output: Queue receiving the state of the job (see JobQueue.get) whenever it changes, starting with the current one
+        """
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers[job_id][subscriber] = None
+            # Started on first use, in the worker process (and with the threading module gevent patched in it)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name="progress-broker")
+                self._poller.daemon = True
+                self._poller.start()
+        return subscriber
+
+    def unsubscribe(self, job_id, subscriber):
+        with self._lock:
+            self._subscribers[job_id].pop(subscriber, None)
+            if not self._subscribers[job_id]:
+                del self._subscribers[job_id]
+
+    def _poll(self):
+        """
+        Poll the subscribed jobs until there is none left
+        """
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None
+                    return
+                job_ids = list(self._subscribers)
+            try:
+                states = self.jobs.get_many(job_ids)
+            except Exception as e:
+                logging.error("Could not read the progress of {} job(s): {}".format(len(job_ids), str(e)))
+                states = None
+
+            if states is not None:
+                with self._lock:
+                    for job_id in job_ids:
+                        state = states.get(job_id)
+                        if state is None:
+                            continue
+                        state = {'status': state['status'], 'progress': state['progress']}
+                        subscribers = self._subscribers.get(job_id, {})
+                        for subscriber, last in list(subscribers.items()):
+                            if state != last:
+                                subscriber.put(state)
+                                subscribers[subscriber] = state
+            time.sleep(self.interval)
+
+    def stream(self, job_id, keepalive=progress_keepalive):
+        """
+        Server-sent events of a job: one JSON {status, progress} event per change, until the job is done or failed
+        A comment is sent when nothing changed for keepalive seconds, so that disconnected clients are noticed
+        """
+        subscriber = self.subscribe(job_id)
+        try:
+            while True:
+                try:
+                    state = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "data:" + json.dumps(state) + "\n\n"
+                if state['status'] in (DONE, FAILED):
+                    return
+        finally:
+            self.unsubscribe(job_id, subscriber)
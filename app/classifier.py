@@ -0,0 +1,201 @@
+import logging
+import os
+import pickle
+import threading
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+from metrics import timer
+from parameters import category_threshold, label_mapping
+
+# Category names indexed by class value, used to decode predictions without scanning label_mapping
+label_inverse = {int(value): key for key, value in label_mapping.items()}
+
+# Category of the transactions the model is not confident about
+FALLBACK_CATEGORY = "Other"
+
+# Versioned models trained from the transactions store (see training.py), and the file naming the one in use
+MODELS_FOLDER = 'models'
+CURRENT_MODEL = 'current.txt'
+
+# Original model and its fitted vectorizer, compiled into a single joblib file on first load (or by running this module)
+COMPILED_MODEL = 'finalised_model.joblib'
+
+
+def dump_model(path, vectorizer, model):
+    """
+    Write a vectorizer and its model to one joblib file, uncompressed so that its arrays can be memory mapped
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    joblib.dump({'vectorizer': vectorizer, 'model': model}, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_model(path, mmap_mode='r'):
+    """
+    Output: (vectorizer, model) of a joblib file
+    Arrays are memory mapped read only by default: every worker process shares the same pages of the file
+    """
+    artifact = joblib.load(path, mmap_mode=mmap_mode)
+    return artifact['vectorizer'], artifact['model']
+
+
+class ModelRegistry(object):
+    """
+    Holds the category model and its fitted vectorizer for one ML folder
+    The files are loaded once per worker, shared across threads, and reloaded when they change on disk
+    The current versioned model is used when there is one, the original model otherwise
+    """
+
+    def __init__(self, ml_folder):
+        self.model_path = os.path.join(ml_folder, 'finalised_model.sav')
+        self.vocabulary_path = os.path.join(ml_folder, 'sentences_train.npy')
+        self.current_path = os.path.join(ml_folder, MODELS_FOLDER, CURRENT_MODEL)
+        self.compiled_path = os.path.join(ml_folder, COMPILED_MODEL)
+        self._lock = threading.Lock()
+        # (files signature, vectorizer, model), swapped as a whole so readers never see a partial reload
+        self._loaded = None
+
+    def _signature(self):
+        """
+        Output: modification time and size of the model files, used to detect changes on disk
+        """
+        signature = []
+        if os.path.exists(self.current_path):
+            paths = (self.current_path,)
+        else:
+            paths = (self.model_path, self.vocabulary_path)
+        for path in paths:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime, stat.st_size))
+        return tuple(signature)
+
+    def _load(self):
+        """
+        Memory map the current versioned model and its vectorizer, or the compiled original model
+        """
+        if os.path.exists(self.current_path):
+            with open(self.current_path) as f:
+                artifact_path = os.path.join(os.path.dirname(self.current_path), f.read().strip())
+            logging.info("Loading category model from {}".format(artifact_path))
+            if artifact_path.endswith(".sav"):
+                # Versions saved before the joblib format
+                with open(artifact_path, 'rb') as f:
+                    artifact = pickle.load(f)
+                return artifact['vectorizer'], artifact['model']
+            return load_model(artifact_path)
+        return self._load_original()
+
+    def _load_original(self):
+        """
+        Memory map the compiled original model, compiling it first if missing or older than the model files
+        """
+        sources = max(os.path.getmtime(self.model_path), os.path.getmtime(self.vocabulary_path))
+        if not os.path.exists(self.compiled_path) or os.path.getmtime(self.compiled_path) < sources:
+            try:
+                self.compile_original()
+            except OSError as e:
+                # e.g. read-only ML folder, the model is then fitted by every worker
+                logging.error("Could not compile the category model: {}".format(str(e)))
+                return self._fit_original()
+        logging.info("Loading category model from {}".format(self.compiled_path))
+        return load_model(self.compiled_path)
+
+    def _fit_original(self):
+        """
+        Unpickle the original model and fit the vectorizer on the training vocabulary
+        """
+        logging.info("Loading category model from {}".format(self.model_path))
+        with open(self.model_path, 'rb') as f:
+            model = pickle.load(f)
+        sentences_train = np.load(self.vocabulary_path, allow_pickle=True)
+
+        vectorizer = CountVectorizer()
+        vectorizer.fit(sentences_train)
+        return vectorizer, model
+
+    def original(self):
+        """
+        Output: (vectorizer, model) of the original model, whichever version is in use
+        """
+        return self._load_original()
+
+    def compile_original(self):
+        """
+        Save the original model and its fitted vectorizer as one joblib file, loaded without refitting
+        """
+        vectorizer, model = self._fit_original()
+        dump_model(self.compiled_path, vectorizer, model)
+        logging.info("Category model compiled to {}".format(self.compiled_path))
+
+    def get(self):
+        """
+        Output: (vectorizer, model) tuple, reloaded first if the model files changed on disk
+        """
+        signature = self._signature()
+        loaded = self._loaded
+        if loaded is None or loaded[0] != signature:
+            with self._lock:
+                loaded = self._loaded
+                if loaded is None or loaded[0] != signature:
+                    with timer('bsa_model_load_seconds'):
+                        loaded = (signature,) + self._load()
+                    self._loaded = loaded
+        return loaded[1], loaded[2]
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_registry(ml_folder):
+    """
+    Return the worker-wide ModelRegistry for an ML folder, creating it on first use
+    """
+    key = os.path.realpath(ml_folder)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.setdefault(key, ModelRegistry(key))
+    return registry
+
+
+def decode_labels(classes):
+    """
+    Input: Class values of a fitted model (model.classes_), label_mapping ids or category names
+    Output: numpy array of category names aligned with the classes
+    """
+    return np.array([label_inverse.get(int(value)) if isinstance(value, (int, np.integer)) else value
+                     for value in classes], dtype=object)
+
+def classify_references(references, ml_folder, threshold=category_threshold):
+    """
+    Predict the categories of a whole column of references in one vectorised call
+    Input: Transaction references (list or pandas Series)
+    Output: numpy array of categories, "Other" where the confidence is not above the threshold
+    """
+    if not len(references):
+        return np.array([], dtype=object)
+    vectorizer, model = get_registry(ml_folder).get()
+    return predict_categories(vectorizer, model, references, threshold)
+
+def predict_categories(vectorizer, model, references, threshold=category_threshold):
+    """
+    Output: numpy array of the categories a given model predicts, "Other" where the confidence is not above the threshold
+    """
+    references = [str(reference) for reference in references]
+    if not references:
+        return np.array([], dtype=object)
+
+    proba = model.predict_proba(vectorizer.transform(references))
+    best = proba.argmax(axis=1)
+    # Rounded to 2 decimals like the original per-reference prediction, so the threshold keeps its meaning
+    confidence = np.round(proba[np.arange(len(best)), best], 2)
+
+    return np.where(confidence > threshold, decode_labels(model.classes_)[best], FALLBACK_CATEGORY)
+
+
+if __name__ == "__main__":
+    # Precompile the original model, e.g. when building the Docker image
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    get_registry(os.path.dirname(os.path.realpath(__file__)) + "/ml/").compile_original()
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue(object):
+    """
+    Queue of background jobs kept in a local SQLite file, shared by the web workers and the job workers
+    Web workers submit jobs and read their state, job workers claim them and report progress
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as cnxn:
+            cnxn.execute("PRAGMA journal_mode=WAL")
+            cnxn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL,
+                progress INTEGER NOT NULL, result TEXT, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)""")
+            cnxn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+
+    def _connect(self):
+        # Autocommit mode, transactions are opened explicitly where needed
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _execute(self, query, parameters=()):
+        cnxn = self._connect()
+        try:
+            return cnxn.execute(query, parameters).fetchall()
+        finally:
+            cnxn.close()
+
+    def submit(self, kind, payload):
+        """
+        Input: Job kind and JSON serialisable payload
+        Output: Id of the queued job
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute("INSERT INTO jobs (id, kind, payload, status, progress, created, updated) VALUES (?, ?, ?, ?, 0, ?, ?)",
+                      (job_id, kind, json.dumps(payload), QUEUED, now, now))
+        logging.info("Job {} ({}) queued".format(job_id, kind))
+        return job_id
+
+    def submit_once(self, kind, payload):
+        """
+        Submit a job unless one of the same kind and payload is already queued or running
+        Input: Job kind and JSON serialisable payload
+        Output: Id of the queued job, or of the pending job found
+        """
+        payload = json.dumps(payload)
+        cnxn = self._connect()
+        try:
+            # The write lock is taken upfront so that two requests cannot both find no pending job
+            cnxn.execute("BEGIN IMMEDIATE")
+            row = cnxn.execute("SELECT id FROM jobs WHERE kind = ? AND payload = ? AND status IN (?, ?) ORDER BY created LIMIT 1",
+                               (kind, payload, QUEUED, RUNNING)).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                now = time.time()
+                cnxn.execute("INSERT INTO jobs (id, kind, payload, status, progress, created, updated) VALUES (?, ?, ?, ?, 0, ?, ?)",
+                             (job_id, kind, payload, QUEUED, now, now))
+            cnxn.execute("COMMIT")
+        except Exception:
+            cnxn.execute("ROLLBACK")
+            raise
+        finally:
+            cnxn.close()
+        if row is not None:
+            logging.info("Job {} ({}) already pending".format(row[0], kind))
+            return row[0]
+        logging.info("Job {} ({}) queued".format(job_id, kind))
+        return job_id
+
+    def claim(self, stale_after):
+        """
+        Mark the oldest queued job as running, jobs left running without progress for stale_after seconds
+        (e.g. their worker was killed) being queued again first
+        Output: (job id, kind, payload) or None when the queue is empty
+        """
+        cnxn = self._connect()
+        try:
+            # The write lock is taken upfront so that two workers cannot claim the same job
+            cnxn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            cnxn.execute("UPDATE jobs SET status = ?, updated = ? WHERE status = ? AND updated < ?",
+                         (QUEUED, now, RUNNING, now - stale_after))
+            row = cnxn.execute("SELECT id, kind, payload FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)).fetchone()
+            if row is not None:
+                cnxn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (RUNNING, now, row[0]))
+            cnxn.execute("COMMIT")
+        except Exception:
+            cnxn.execute("ROLLBACK")
+            raise
+        finally:
+            cnxn.close()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def set_progress(self, job_id, progress):
+        self._execute("UPDATE jobs SET progress = ?, updated = ? WHERE id = ?", (int(progress), time.time(), job_id))
+
+    def finish(self, job_id, result=None):
+        self._execute("UPDATE jobs SET status = ?, progress = 100, result = ?, updated = ? WHERE id = ?",
+                      (DONE, json.dumps(result), time.time(), job_id))
+        logging.info("Job {} done".format(job_id))
+
+    def fail(self, job_id, error):
+        self._execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                      (FAILED, str(error), time.time(), job_id))
+        logging.critical("Job {} failed : {}".format(job_id, str(error)))
+
+    def get(self, job_id):
+        """
+        Output: Dictionary with the id, kind, status, progress, result and error of a job, None if it does not exist
+        """
+        return self.get_many([job_id]).get(job_id)
+
+    def owner(self, job_id):
+        """
+        Output: Id of the user who submitted a job (the 'owner' of its payload), None for jobs submitted by the workers
+        """
+        rows = self._execute("SELECT payload FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(rows[0][0]).get('owner') if rows else None
+
+    def get_many(self, job_ids):
+        """
+        Output: Dictionary of job id: job (see get) of the jobs found, read in one query per 500 jobs
+        (older SQLite versions allow 999 parameters per query)
+        """
+        job_ids = list(job_ids)
+        rows = []
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            rows += self._execute("SELECT id, kind, status, progress, result, error FROM jobs WHERE id IN ({})".format(
+                ",".join("?" * len(chunk))), chunk)
+        return {job_id: {'id': job_id, 'kind': kind, 'status': status, 'progress': progress,
+                         'result': json.loads(result) if result else None, 'error': error}
+                for job_id, kind, status, progress, result, error in rows}
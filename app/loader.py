@@ -0,0 +1,219 @@
+import logging
+
+import pandas as pd
+
+from parameters import db_chunk_size
+from rollup import apply_rollup, rollup_deltas
+
+COLUMNS = ['ID', 'Date', 'Value', 'Sign', 'Category', 'Reference']
+
+
+def transaction_rows(df):
+    """
+    Input: Transactions dataframe
+    Output: List of parameter tuples in COLUMNS order, with NaN/NaT replaced by None
+    Tables parsed before the Sign column existed are loaded without sign
+    """
+    rows = []
+    for transaction_id, date, value, sign, category, reference in df.reindex(columns=COLUMNS).itertuples(index=False):
+        rows.append((
+            str(transaction_id),
+            None if pd.isnull(date) else pd.Timestamp(date).to_pydatetime(),
+            None if pd.isnull(value) else float(value),
+            None if pd.isnull(sign) else int(sign),
+            None if pd.isnull(category) else str(category),
+            None if pd.isnull(reference) else str(reference),
+        ))
+    return rows
+
+def ensure_sign_column(cnxn, table):
+    """
+    Add the Sign column to a transactions table created before it
+    Another process may add it at the same time, the column only has to exist afterwards
+    """
+    def has_sign():
+        cursor.execute("SELECT * FROM {} WHERE 1 = 0".format(table))
+        names = [column[0] for column in cursor.description]
+        cursor.fetchall()
+        return 'Sign' in names
+
+    cursor = cnxn.cursor()
+    try:
+        if has_sign():
+            return
+        try:
+            cursor.execute("ALTER TABLE {} ADD [Sign] smallint".format(table))
+            cnxn.commit()
+            logging.info("Sign column added to {}".format(table))
+        except Exception:
+            cnxn.rollback()
+            if not has_sign():
+                raise
+    finally:
+        cursor.close()
+
+def insert_transactions(cnxn, df, table, chunk_size=db_chunk_size, rollup=None):
+    """
+    Insert transactions with a parameterised executemany, committing once per chunk
+    When a chunk fails (e.g. duplicate IDs), its rows are retried one by one so that every row is counted
+    The inserted rows are added to the rollup table, if any, in the same transaction
+    Output: Generator of (rows processed, succeeded, failed) after each chunk
+    """
+    query = "INSERT INTO {}([ID],[Date],[Value],[Sign],[Category],[Reference]) VALUES (?,?,?,?,?,?)".format(table)
+    rows = transaction_rows(df)
+    succeeded = 0
+    failed = 0
+
+    cursor = cnxn.cursor()
+    # pyodbc sends the whole chunk in a single round trip
+    if hasattr(cursor, 'fast_executemany'):
+        cursor.fast_executemany = True
+
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            try:
+                cursor.executemany(query, chunk)
+                if rollup is not None:
+                    apply_rollup(cnxn, rollup, rollup_deltas(chunk))
+                cnxn.commit()
+                succeeded += len(chunk)
+            except Exception as e:
+                logging.debug("SQL bulk insert failed, retrying rows one by one: {}".format(str(e)))
+                cnxn.rollback()
+                for row in chunk:
+                    try:
+                        cursor.execute(query, row)
+                        if rollup is not None:
+                            apply_rollup(cnxn, rollup, rollup_deltas([row]))
+                        cnxn.commit()
+                        succeeded += 1
+                    except Exception as e:
+                        logging.debug("SQL Insert failed: {}".format(str(e)))
+                        cnxn.rollback()
+                        failed += 1
+            yield start + len(chunk), succeeded, failed
+    finally:
+        cursor.close()
+
+def upsert_transactions(cnxn, df, table, dialect='mssql', chunk_size=db_chunk_size, rollup=None):
+    """
+    Bulk load transactions into a staging table, then apply them to the table in one set-based statement keyed on ID
+    New IDs are inserted, existing IDs with different values are updated, identical rows are left untouched
+    The rollup table, if any, is updated in the same transaction: the previous version of the rows is removed, the new one added
+    Output: Generator of (rows staged, counts) after each chunk, counts being None until the final
+    (inserted, updated, unchanged, duplicates) tuple yielded once the merge is committed
+    """
+    # Last occurrence wins when a statement contains the same ID twice, the earlier ones are dropped and counted
+    all_rows = transaction_rows(df)
+    rows = list(dict((row[0], row) for row in all_rows).values())
+    duplicates = len(all_rows) - len(rows)
+    if duplicates:
+        logging.warning("Upsert: {} row(s) dropped, their ID appears again later in the table".format(duplicates))
+
+    cursor = cnxn.cursor()
+    if hasattr(cursor, 'fast_executemany'):
+        cursor.fast_executemany = True
+
+    try:
+        if dialect == 'sqlite':
+            staging = "temp.staging_transactions"
+            cursor.execute("DROP TABLE IF EXISTS {}".format(staging))
+            cursor.execute("CREATE TEMP TABLE staging_transactions (ID varchar(255) NOT NULL PRIMARY KEY, Date datetime, Value float, Sign smallint, Category varchar(255), Reference varchar(255))")
+        else:
+            staging = "#staging_transactions"
+            cursor.execute("IF OBJECT_ID('tempdb..#staging_transactions') IS NOT NULL DROP TABLE #staging_transactions")
+            cursor.execute("CREATE TABLE #staging_transactions (ID varchar(255) NOT NULL PRIMARY KEY, Date datetime, Value float, Sign smallint, Category varchar(255), Reference varchar(255))")
+            # Explicit parameter types, the driver cannot describe the parameters of a temporary table
+            import pyodbc
+            cursor.setinputsizes([(pyodbc.SQL_VARCHAR, 255, 0), (pyodbc.SQL_TYPE_TIMESTAMP, 23, 3), (pyodbc.SQL_DOUBLE, 0, 0),
+                                  (pyodbc.SQL_SMALLINT, 0, 0), (pyodbc.SQL_VARCHAR, 255, 0), (pyodbc.SQL_VARCHAR, 255, 0)])
+
+        query = "INSERT INTO {}([ID],[Date],[Value],[Sign],[Category],[Reference]) VALUES (?,?,?,?,?,?)".format(staging)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            cursor.executemany(query, chunk)
+            yield start + len(chunk), None
+
+        if rollup is not None:
+            deltas = rollup_deltas(rows)
+            rollup_deltas(_staged_previous_rows(cnxn, table, staging), -1, deltas)
+
+        if dialect == 'sqlite':
+            inserted, updated = _apply_staging_sqlite(cursor, table, staging)
+        else:
+            inserted, updated = _apply_staging_mssql(cursor, table, staging)
+        if rollup is not None:
+            apply_rollup(cnxn, rollup, deltas)
+        cnxn.commit()
+    except Exception:
+        cnxn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    logging.info("Upsert: {} inserted, {} updated, {} unchanged".format(inserted, updated, len(rows) - inserted - updated))
+    yield len(rows), (inserted, updated, len(rows) - inserted - updated, duplicates)
+
+def _staged_previous_rows(cnxn, table, staging):
+    """
+    Output: Current rows of the table whose ID is in the staging table, in COLUMNS order
+    """
+    # Separate cursor, the staging cursor may carry input sizes
+    cursor = cnxn.cursor()
+    try:
+        cursor.execute("SELECT t.[ID], t.[Date], t.[Value], t.[Sign], t.[Category], t.[Reference] FROM {} t JOIN {} s ON s.[ID] = t.[ID]".format(table, staging))
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+def _apply_staging_mssql(cursor, table, staging):
+    """
+    Single MERGE of the staging table into the transactions table
+    Output: (inserted, updated) counts, read from the MERGE output clause
+    """
+    cursor.execute("""
+        MERGE {table} AS target
+        USING {staging} AS source
+        ON target.[ID] = source.[ID]
+        WHEN MATCHED AND EXISTS (
+            SELECT target.[Date], target.[Value], target.[Sign], target.[Category], target.[Reference]
+            EXCEPT
+            SELECT source.[Date], source.[Value], source.[Sign], source.[Category], source.[Reference]
+        ) THEN
+            UPDATE SET [Date] = source.[Date], [Value] = source.[Value], [Sign] = source.[Sign], [Category] = source.[Category], [Reference] = source.[Reference]
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT ([ID],[Date],[Value],[Sign],[Category],[Reference])
+            VALUES (source.[ID], source.[Date], source.[Value], source.[Sign], source.[Category], source.[Reference])
+        OUTPUT $action;
+    """.format(table=table, staging=staging))
+    actions = [row[0] for row in cursor.fetchall()]
+    return actions.count('INSERT'), actions.count('UPDATE')
+
+def _apply_staging_sqlite(cursor, table, staging):
+    """
+    SQLite equivalent of the MERGE, as one UPDATE of the changed rows followed by one INSERT of the new ones
+    Uses plain UPDATE/INSERT ... SELECT so that it also runs on SQLite versions without upsert support
+    Output: (inserted, updated) counts
+    """
+    cursor.execute("""
+        UPDATE {table} SET
+            [Date] = (SELECT s.[Date] FROM {staging} s WHERE s.[ID] = {table}.[ID]),
+            [Value] = (SELECT s.[Value] FROM {staging} s WHERE s.[ID] = {table}.[ID]),
+            [Sign] = (SELECT s.[Sign] FROM {staging} s WHERE s.[ID] = {table}.[ID]),
+            [Category] = (SELECT s.[Category] FROM {staging} s WHERE s.[ID] = {table}.[ID]),
+            [Reference] = (SELECT s.[Reference] FROM {staging} s WHERE s.[ID] = {table}.[ID])
+        WHERE [ID] IN (
+            SELECT s.[ID] FROM {staging} s JOIN {table} t ON t.[ID] = s.[ID]
+            WHERE t.[Date] IS NOT s.[Date] OR t.[Value] IS NOT s.[Value] OR t.[Sign] IS NOT s.[Sign]
+               OR t.[Category] IS NOT s.[Category] OR t.[Reference] IS NOT s.[Reference]
+        )
+    """.format(table=table, staging=staging))
+    updated = cursor.rowcount
+    cursor.execute("""
+        INSERT INTO {table} ([ID],[Date],[Value],[Sign],[Category],[Reference])
+        SELECT s.[ID], s.[Date], s.[Value], s.[Sign], s.[Category], s.[Reference] FROM {staging} s
+        WHERE s.[ID] NOT IN (SELECT [ID] FROM {table})
+    """.format(table=table, staging=staging))
+    inserted = cursor.rowcount
+    return inserted, updated
@@ -0,0 +1,190 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+from fuzzywuzzy import fuzz
+
+from classifier import FALLBACK_CATEGORY, classify_references
+from metrics import increment
+from parameters import (category_threshold, merchant_candidates,
+                        merchant_fuzzy_threshold, merchant_index_ttl,
+                        merchant_min_length)
+
+# Anything but letters: store numbers, dates and punctuation vary between statements of the same merchant
+NOT_LETTERS = re.compile(r'[^A-Z]+')
+# Kinds of transaction printed before and after the merchant name, removed before matching merchants fuzzily
+# References come out of parse_statement without spaces ("CBINTERMARCHEFACT"), so they are matched as letter affixes
+TRANSACTION_PREFIX = re.compile(r'^(?:PRLVSEPA|PRLV|VIRSEPA|VIREMENT|VIR|RETRAITDAB|PAIEMENTCB|CARTE|CB)')
+TRANSACTION_SUFFIX = re.compile(r'FACT$')
+TIERS = ('exact', 'fuzzy', 'model')
+
+
+def normalise_reference(reference):
+    """
+    Key of the exact lookup
+    Input: Transaction reference, e.g. "CARREFMARKETDAC 0607"
+    Output: Upper case letters only, e.g. "CARREFMARKETDAC"
+    """
+    return NOT_LETTERS.sub("", str(reference).upper())
+
+def merchant_key(reference):
+    """
+    Key of the fuzzy lookup: the merchant name left once the kind of transaction is removed
+    Input: Transaction reference, e.g. "CBCARREFOURMARKETFACT" (or "CB CARREFOUR MARKET FACT 201216")
+    Output: Upper case letters without the transaction prefix and suffix, e.g. "CARREFOURMARKET"
+    """
+    key = normalise_reference(reference)
+    return TRANSACTION_SUFFIX.sub("", TRANSACTION_PREFIX.sub("", key))
+
+def trigrams(key):
+    return set(key[i:i + 3] for i in range(max(len(key) - 2, 1)))
+
+
+class MerchantIndex(object):
+    """
+    Merchant to category index built from the stored transactions, in front of the category model
+    A reference is looked up by its letters first, then fuzzily by its merchant name among the merchants sharing
+    the most trigrams with it; only the references left are sent to the model
+    The index is rebuilt from load_entries() once it is older than ttl seconds
+    """
+
+    def __init__(self, load_entries, ttl=merchant_index_ttl, fuzzy_threshold=merchant_fuzzy_threshold,
+                 candidates=merchant_candidates, min_length=merchant_min_length):
+        self._load_entries = load_entries
+        self.ttl = ttl
+        self.fuzzy_threshold = fuzzy_threshold
+        self.candidates = candidates
+        self.min_length = min_length
+        self._lock = threading.Lock()
+        # (built, categories by key, categories by merchant name, names by trigram), swapped as a whole when rebuilt
+        self._index = None
+        self._metrics = {tier: {'count': 0, 'seconds': 0.0} for tier in TIERS}
+
+    def _build(self):
+        """
+        Output: Index of the (reference, category) entries, each merchant taking its most frequent category
+        """
+        votes = defaultdict(Counter)
+        name_votes = defaultdict(Counter)
+        for reference, category in self._load_entries():
+            if not category or category == FALLBACK_CATEGORY:
+                continue
+            key = normalise_reference(reference)
+            if key:
+                votes[key][category] += 1
+            name = merchant_key(reference)
+            if len(name) >= self.min_length:
+                name_votes[name][category] += 1
+        categories = {key: counter.most_common(1)[0][0] for key, counter in votes.items()}
+        name_categories = {name: counter.most_common(1)[0][0] for name, counter in name_votes.items()}
+        names_by_trigram = defaultdict(list)
+        for name in name_categories:
+            for trigram in trigrams(name):
+                names_by_trigram[trigram].append(name)
+        logging.info("Merchant index built with {} merchants".format(len(categories)))
+        return time.time(), categories, name_categories, names_by_trigram
+
+    def _current(self):
+        index = self._index
+        if index is None or time.time() - index[0] > self.ttl:
+            with self._lock:
+                index = self._index
+                if index is None or time.time() - index[0] > self.ttl:
+                    index = self._build()
+                    self._index = index
+        return index
+
+    def invalidate(self):
+        """
+        Rebuild the index on next lookup, e.g. after new transactions were stored
+        """
+        self._index = None
+
+    def lookup(self, reference):
+        """
+        Output: (category, tier) of a reference, tier being 'exact' or 'fuzzy', (None, None) when not found
+        """
+        _, categories, name_categories, names_by_trigram = self._current()
+        key = normalise_reference(reference)
+        if not key:
+            return None, None
+        if key in categories:
+            return categories[key], 'exact'
+
+        # Partial matching of the merchant names: "CARREFOURMARKET" finds "CARREFOUR", which it contains
+        # Names shorter than min_length would be found inside too many unrelated names
+        name = merchant_key(reference)
+        if len(name) < self.min_length:
+            return None, None
+        # Prefilter: only the merchants sharing the most trigrams are scored
+        shared = Counter()
+        for trigram in trigrams(name):
+            shared.update(names_by_trigram.get(trigram, ()))
+        best, best_name = (0, 0), None
+        for candidate, _ in shared.most_common(self.candidates):
+            # Equal scores go to the name closest in length, the most specific merchant
+            score = (fuzz.partial_ratio(name, candidate), -abs(len(name) - len(candidate)))
+            if score > best:
+                best, best_name = score, candidate
+        if best[0] >= self.fuzzy_threshold:
+            return name_categories[best_name], 'fuzzy'
+        return None, None
+
+    def categorise(self, references, ml_folder, threshold=category_threshold):
+        """
+        Categorise a column of references, the model only classifying the merchants missing from the index
+        Output: numpy array of categories
+        """
+        references = [str(reference) for reference in references]
+        categories = np.empty(len(references), dtype=object)
+        counts = Counter()
+        seconds = Counter()
+        missing = []
+        # Statements repeat the same merchants, each distinct reference is looked up once
+        found = {}
+        for position, reference in enumerate(references):
+            if reference not in found:
+                start = time.time()
+                found[reference] = self.lookup(reference)
+                seconds[found[reference][1] or 'model'] += time.time() - start
+            category, tier = found[reference]
+            if tier is None:
+                missing.append(position)
+            else:
+                categories[position] = category
+                counts[tier] += 1
+
+        if missing:
+            start = time.time()
+            categories[missing] = classify_references([references[position] for position in missing], ml_folder, threshold)
+            seconds['model'] += time.time() - start
+            counts['model'] += len(missing)
+
+        self._record(counts, seconds)
+        return categories
+
+    def _record(self, counts, seconds):
+        with self._lock:
+            for tier in TIERS:
+                self._metrics[tier]['count'] += counts[tier]
+                self._metrics[tier]['seconds'] += seconds[tier]
+        for tier in TIERS:
+            increment('bsa_merchant_lookups_total', counts[tier], tier=tier)
+
+    def metrics(self):
+        """
+        Output: Dictionary with the hit rate of the exact and fuzzy lookups, and for each tier the number of
+        references it categorised and their average latency in milliseconds (failed lookups count as model time)
+        """
+        with self._lock:
+            metrics = {tier: dict(values) for tier, values in self._metrics.items()}
+        total = sum(metrics[tier]['count'] for tier in TIERS)
+        result = {'hit_rate': (metrics['exact']['count'] + metrics['fuzzy']['count']) / float(total) if total else 0.0}
+        for tier in TIERS:
+            count = metrics[tier]['count']
+            result[tier] = count
+            result[tier + '_latency_ms'] = 1000 * metrics[tier]['seconds'] / count if count else 0.0
+        return result
@@ -0,0 +1,260 @@
+import atexit
+import cProfile
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+from parameters import metrics_database, metrics_enabled
+
+# Histogram upper bounds: durations in seconds, and database load throughput in rows per second
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+# Metric name: (help, histogram buckets, None for counters)
+METRICS = {
+    'bsa_rasterise_page_seconds': ("Time to rasterise one pdf page for OCR", LATENCY_BUCKETS),
+    'bsa_preprocess_page_seconds': ("Time to binarise, deskew and crop one page before OCR", LATENCY_BUCKETS),
+    'bsa_ocr_page_seconds': ("Tesseract OCR time per page", LATENCY_BUCKETS),
+    'bsa_parse_statement_seconds': ("Time to parse the text of one statement", LATENCY_BUCKETS),
+    'bsa_classify_seconds': ("Time to categorise the transactions of a table (one or more statements)", LATENCY_BUCKETS),
+    'bsa_db_load_rows_per_second': ("Database load throughput of an upload", THROUGHPUT_BUCKETS),
+    'bsa_model_load_seconds': ("Category model loads (count) and their duration", LATENCY_BUCKETS),
+    'bsa_job_seconds': ("Background job duration, by kind and status", LATENCY_BUCKETS),
+    'bsa_pages_total': ("Statement pages by text source: text_layer, cache or ocr", None),
+    'bsa_merchant_lookups_total': ("References categorised by tier: exact, fuzzy (merchant index) or model", None),
+}
+
+# Ratios computed from counters when rendered: (help, counter, label, numerator values, denominator values)
+RATIOS = {
+    'bsa_ocr_cache_hit_ratio': ("Share of the pages without text layer found in the OCR cache",
+                                'bsa_pages_total', 'source', ('cache',), ('cache', 'ocr')),
+    'bsa_merchant_hit_ratio': ("Share of the references categorised by the merchant index",
+                               'bsa_merchant_lookups_total', 'tier', ('exact', 'fuzzy'), ('exact', 'fuzzy', 'model')),
+}
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(key, str(value).replace('"', '')) for key, value in sorted(labels.items()))
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class MetricsStore(object):
+    """
+    Counters and histograms kept in a local SQLite file, so that the web workers, job workers and OCR processes
+    all add to the same metrics and any web worker can serve them
+    Histogram buckets are stored as plain counts, and made cumulative when rendered
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cnxn = self._connect()
+        try:
+            cnxn.execute("PRAGMA journal_mode=WAL")
+            cnxn.execute("CREATE TABLE IF NOT EXISTS samples (name TEXT NOT NULL, labels TEXT NOT NULL, le TEXT NOT NULL, "
+                         "value REAL NOT NULL, PRIMARY KEY (name, labels, le))")
+        finally:
+            cnxn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def add(self, samples):
+        """
+        Input: List of (name, labels, le, amount) to add, in one transaction
+        INSERT OR IGNORE then UPDATE, as upserts need SQLite 3.24
+        """
+        cnxn = self._connect()
+        try:
+            cnxn.execute("BEGIN IMMEDIATE")
+            for name, labels, le, amount in samples:
+                cnxn.execute("INSERT OR IGNORE INTO samples (name, labels, le, value) VALUES (?, ?, ?, 0)", (name, labels, le))
+                cnxn.execute("UPDATE samples SET value = value + ? WHERE name = ? AND labels = ? AND le = ?", (amount, name, labels, le))
+            cnxn.execute("COMMIT")
+        finally:
+            cnxn.close()
+
+    def render(self):
+        """
+        Output: Metrics in the Prometheus text exposition format
+        """
+        cnxn = self._connect()
+        try:
+            rows = cnxn.execute("SELECT name, labels, le, value FROM samples").fetchall()
+        finally:
+            cnxn.close()
+        samples = defaultdict(lambda: defaultdict(dict))
+        for name, labels, le, value in rows:
+            samples[name][labels][le] = value
+
+        lines = []
+        for name in sorted(METRICS):
+            description, buckets = METRICS[name]
+            lines += ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, "histogram" if buckets else "counter")]
+            for labels, values in sorted(samples[name].items()):
+                if not buckets:
+                    lines.append("{}{} {}".format(name, "{" + labels + "}" if labels else "", format_value(values.get('', 0))))
+                    continue
+                cumulative = 0
+                for bound in [str(bound) for bound in buckets] + ['+Inf']:
+                    cumulative += values.get(bound, 0)
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels + "," if labels else "", bound, format_value(cumulative)))
+                for suffix in ('sum', 'count'):
+                    lines.append("{}_{}{} {}".format(name, suffix, "{" + labels + "}" if labels else "", format_value(values.get(suffix, 0))))
+
+        for name in sorted(RATIOS):
+            description, counter, label, numerator, denominator = RATIOS[name]
+            totals = defaultdict(float)
+            for labels, values in samples[counter].items():
+                totals[labels] += values.get('', 0)
+            hits = sum(totals[format_labels({label: value})] for value in numerator)
+            total = sum(totals[format_labels({label: value})] for value in denominator)
+            lines += ["# HELP {} {}".format(name, description), "# TYPE {} gauge".format(name),
+                      "{} {}".format(name, format_value(hits / total if total else 0))]
+        return "\n".join(lines) + "\n"
+
+
+# Store of the process, created on first use (OCR processes included)
+_store = None
+_store_lock = threading.Lock()
+
+# Samples recorded by the process since the last flush, (name, labels, le): amount
+_pending = defaultdict(float)
+_pending_lock = threading.Lock()
+_pending_pid = os.getpid()
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MetricsStore(metrics_database)
+        return _store
+
+def set_store(path):
+    """
+    Record the metrics of this process to another file, e.g. to keep benchmark runs out of the app metrics
+    """
+    global _store
+    flush_metrics()
+    with _store_lock:
+        _store = MetricsStore(path)
+
+def take_pending():
+    """
+    Output: Samples recorded since the last flush, the buffer being emptied
+    Samples inherited from the parent of a forked process (OCR pool) are the parent's to flush and are dropped
+    """
+    global _pending, _pending_pid
+    pending, _pending = _pending, defaultdict(float)
+    if os.getpid() != _pending_pid:
+        _pending_pid = os.getpid()
+        return defaultdict(float)
+    return pending
+
+def reset_store():
+    """
+    Write the pending samples, then record to metrics_database again, e.g. before deleting the file set by set_store
+    """
+    global _store
+    flush_metrics()
+    with _store_lock:
+        _store = None
+
+def record(samples):
+    with _pending_lock:
+        if os.getpid() != _pending_pid:
+            take_pending()
+        for name, labels, le, amount in samples:
+            _pending[(name, labels, le)] += amount
+
+def flush_metrics():
+    """
+    Write the samples recorded since the last flush to the store in one transaction
+    Called once per request, job and OCR page, failures are logged and never interrupt the processing being measured
+    """
+    with _pending_lock:
+        pending = take_pending()
+    if not pending:
+        return
+    try:
+        get_store().add([key + (amount,) for key, amount in pending.items()])
+    except sqlite3.Error as e:
+        logging.error("Could not record {} metric sample(s): {}".format(len(pending), str(e)))
+
+# Scripts (batch, benchmark) record until they exit
+atexit.register(flush_metrics)
+
+def increment(name, amount=1, **labels):
+    """
+    Add to a counter, kept in memory until the next flush
+    """
+    if not metrics_enabled or not amount:
+        return
+    record([(name, format_labels(labels), '', amount)])
+
+def observe(name, value, **labels):
+    """
+    Add a value (duration, throughput) to a histogram, kept in memory until the next flush
+    """
+    if not metrics_enabled:
+        return
+    buckets = METRICS[name][1]
+    bucket = next((bound for bound in buckets if value <= bound), '+Inf')
+    labels = format_labels(labels)
+    record([(name, labels, str(bucket), 1), (name, labels, 'sum', value), (name, labels, 'count', 1)])
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Observe the duration of a block in a histogram, only when the block succeeds
+    """
+    start = time.time()
+    yield
+    observe(name, time.time() - start, **labels)
+
+def render_metrics():
+    flush_metrics()
+    return get_store().render()
+
+
+def start_profile():
+    """
+    Start profiling the current thread, with pyinstrument when installed, cProfile otherwise
+    """
+    if pyinstrument is not None:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+def save_profile(profiler, folder, name):
+    """
+    Stop a profiler started by start_profile and write its report to folder
+    Output: Report path, a pyinstrument html page or a cProfile stats file (python -m pstats, snakeviz)
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, "{}_{}".format(time.strftime("%Y%m%d-%H%M%S"), name))
+    if pyinstrument is not None:
+        profiler.stop()
+        path += ".html"
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        path += ".prof"
+        profiler.dump_stats(path)
+    logging.info("Profile written to {}".format(path))
+    return path
@@ -0,0 +1,195 @@
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pytesseract
+from pdf2image import convert_from_path
+from pdf2image.exceptions import PDFPageCountError
+
+from metrics import flush_metrics, increment, timer
+from ocr_cache import page_key, pdf_digest
+from parameters import (job_workers, ocr_dpi, ocr_lang, ocr_max_skew,
+                        ocr_preprocess, ocr_psm, ocr_whitelist, ocr_workers,
+                        statement_start, statement_stop, use_text_layer)
+from preprocess import preprocess_page
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Return the worker-wide OCR process pool, created on first use so each gunicorn worker owns its own
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Every job worker owns a pool, so together they use about one process per CPU
+            workers = ocr_workers or max((os.cpu_count() or 1) // job_workers, 1)
+            # One thread per Tesseract process, the pool already uses the CPUs (inherited by the pool processes,
+            # ProcessPoolExecutor has no initializer before python 3.7)
+            os.environ['OMP_THREAD_LIMIT'] = '1'
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+def reset_pool():
+    """
+    Drop a broken pool so that the next OCR run starts a fresh one
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+def pdf_page_count(pdf_path):
+    """
+    Input: Pdf path
+    Output: Number of pages, read with poppler's pdfinfo
+    """
+    output = subprocess.check_output(["pdfinfo", pdf_path]).decode("utf-8", "ignore")
+    match = re.search(r'^Pages:\s+(\d+)', output, re.MULTILINE)
+    if not match:
+        raise PDFPageCountError("Unable to get page count from {}".format(pdf_path))
+    return int(match.group(1))
+
+def rasterise_page(pdf_path, page_number, dpi=ocr_dpi):
+    """
+    Input: Pdf path and page number (starting at 1)
+    Output: Grayscale PIL image of that single page, kept in memory
+    """
+    images = convert_from_path(pdf_path, dpi, first_page=page_number, last_page=page_number)
+    return images[0].convert('L')
+
+def iter_pdf_pages(pdf_path, dpi=ocr_dpi):
+    """
+    Generator of grayscale page images, rasterised one page at a time
+    """
+    for page_number in range(1, pdf_page_count(pdf_path) + 1):
+        yield rasterise_page(pdf_path, page_number, dpi)
+
+def tesseract_config(psm=ocr_psm, whitelist=ocr_whitelist):
+    """
+    Output: Tesseract command line options of the page segmentation mode and character whitelist
+    """
+    config = "--psm {}".format(psm)
+    if whitelist:
+        config += " -c tessedit_char_whitelist=" + shlex.quote(whitelist)
+    return config
+
+def ocr_image(image, lang=ocr_lang):
+    """
+    Preprocess a page image (see preprocess.py) and extract its text with Tesseract
+    """
+    if ocr_preprocess:
+        with timer('bsa_preprocess_page_seconds'):
+            image = preprocess_page(image, ocr_max_skew)
+    with timer('bsa_ocr_page_seconds'):
+        return pytesseract.image_to_string(image, lang=lang, config=tesseract_config())
+
+def ocr_pdf_page(pdf_path, page_number, dpi=ocr_dpi, lang=ocr_lang):
+    """
+    Rasterise a single page and hand the in-memory image straight to Tesseract
+    Runs in the OCR pool, so each process only ever holds one page
+    """
+    try:
+        with timer('bsa_rasterise_page_seconds'):
+            image = rasterise_page(pdf_path, page_number, dpi)
+        return ocr_image(image, lang)
+    finally:
+        # Pool processes are stopped without exit handlers, their metrics are written after each page
+        flush_metrics()
+
+def extract_text_layer(pdf_path, page_count):
+    """
+    Extract the embedded text of a digitally generated pdf with poppler's pdftotext, without any OCR
+    Input: Pdf path and page count
+    Output: List of page texts, empty for pages without a text layer
+    """
+    output = subprocess.check_output(["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"])
+    # Pages are separated by form feeds, lines keep their indentation: parse_statement reads the debit/credit
+    # column from the position of the amounts, and strips the lines after that
+    pages = output.decode("utf-8", "ignore").split("\f")[:page_count]
+    pages = ["\n".join(line.rstrip() for line in page.splitlines()) for page in pages]
+    # Layout spacing can widen the gap between words, restore the markers parse_statement looks for
+    for marker in (statement_start, statement_stop):
+        pattern = re.compile(r'[ \t]+'.join(re.escape(word) for word in marker.split()))
+        pages = [pattern.sub(marker, page) for page in pages]
+    return pages + [""] * (page_count - len(pages))
+
+def has_statement_markers(text):
+    """
+    Check that a text contains the markers parse_statement cuts the transactions table between
+    """
+    return statement_start in text and statement_stop in text
+
+def ocr_settings():
+    """
+    OCR settings that change the extracted text, part of the cache key of every page
+    """
+    return (ocr_dpi, ocr_lang, ocr_preprocess, ocr_max_skew, ocr_psm, ocr_whitelist)
+
+def ocr_pdf(pdf_path, page_count=None, cache=None):
+    """
+    Extract the text of every page of a pdf, OCRing pages in parallel on the OCR process pool
+    Pages read from the pdf text layer or found in the cache are returned straight away without being rasterised
+    Input: Pdf path, its page count if already known, and an optional OCRCache
+    Output: Generator of (page index, extracted text), yielded as each page completes
+    """
+    if page_count is None:
+        page_count = pdf_page_count(pdf_path)
+
+    # Digital statements already contain their text, only pages without a text layer need OCR
+    layer = [""] * page_count
+    if use_text_layer:
+        try:
+            layer = extract_text_layer(pdf_path, page_count)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error("Could not extract the pdf text layer: {}".format(str(e)))
+        if not has_statement_markers("\n".join(layer)):
+            layer = [""] * page_count
+    pending = []
+    for index in range(page_count):
+        if layer[index].strip():
+            yield index, layer[index]
+        else:
+            pending.append(index)
+    logging.info("{}/{} page(s) read from the pdf text layer".format(page_count - len(pending), page_count))
+    increment('bsa_pages_total', page_count - len(pending), source='text_layer')
+
+    keys = {}
+    cached = {}
+    if cache is not None and pending:
+        digest = pdf_digest(pdf_path)
+        keys = {index: page_key(digest, index + 1, ocr_settings()) for index in pending}
+        cached = cache.get_many(list(keys.values()))
+        logging.info("{}/{} page(s) found in the OCR cache".format(len(cached), len(pending)))
+
+    missing = []
+    for index in pending:
+        if index in keys and keys[index] in cached:
+            yield index, cached[keys[index]]
+        else:
+            missing.append(index)
+    if cache is not None:
+        increment('bsa_pages_total', len(pending) - len(missing), source='cache')
+    increment('bsa_pages_total', len(missing), source='ocr')
+
+    if not missing:
+        return
+    try:
+        futures = {get_pool().submit(ocr_pdf_page, pdf_path, index + 1): index for index in missing}
+        for future in as_completed(futures):
+            index = futures[future]
+            text = future.result()
+            if cache is not None:
+                cache.put(keys[index], text)
+            yield index, text
+    except BrokenProcessPool:
+        logging.critical("OCR process pool terminated abruptly, restarting it on next use")
+        reset_pool()
+        raise
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+
+def pdf_digest(pdf_path):
+    """
+    Input: Pdf path
+    Output: sha256 hex digest of the pdf bytes
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def page_key(digest, page_number, settings):
+    """
+    Cache key of one page: pdf digest, page number and the OCR settings that produced the text
+    """
+    key = "{}:{}:{}".format(digest, page_number, ":".join(str(setting) for setting in settings))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class OCRCache(object):
+    """
+    Persistent store of extracted page text in a local SQLite file
+    The least recently used pages are evicted once the stored text exceeds max_bytes
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as cnxn:
+            cnxn.execute("CREATE TABLE IF NOT EXISTS ocr_pages (key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            cnxn.execute("CREATE INDEX IF NOT EXISTS ocr_pages_last_access ON ocr_pages (last_access)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, keys):
+        """
+        Input: List of page keys
+        Output: Dictionary of the cached texts found, keyed by page key
+        """
+        if not keys:
+            return {}
+        try:
+            cnxn = self._connect()
+            try:
+                with cnxn:
+                    placeholders = ",".join("?" * len(keys))
+                    rows = cnxn.execute("SELECT key, text FROM ocr_pages WHERE key IN ({})".format(placeholders), keys).fetchall()
+                    cnxn.execute("UPDATE ocr_pages SET last_access = ? WHERE key IN ({})".format(placeholders), [time.time()] + list(keys))
+            finally:
+                cnxn.close()
+        except sqlite3.Error as e:
+            logging.error("OCR cache lookup failed: {}".format(str(e)))
+            return {}
+        return dict(rows)
+
+    def put(self, key, text):
+        """
+        Store the text of one page, then evict the least recently used pages if the cache is full
+        """
+        try:
+            cnxn = self._connect()
+            try:
+                with cnxn:
+                    cnxn.execute("INSERT OR REPLACE INTO ocr_pages (key, text, size, last_access) VALUES (?, ?, ?, ?)",
+                                 (key, text, len(text.encode("utf-8")), time.time()))
+                    self._evict(cnxn)
+            finally:
+                cnxn.close()
+        except sqlite3.Error as e:
+            logging.error("OCR cache write failed: {}".format(str(e)))
+
+    def _evict(self, cnxn):
+        total = cnxn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_pages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in cnxn.execute("SELECT key, size FROM ocr_pages ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        cnxn.executemany("DELETE FROM ocr_pages WHERE key = ?", evicted)
+        logging.info("Evicted {} page(s) from the OCR cache".format(len(evicted)))
@@ -1,28 +1,135 @@
-# Azure SQL Database parameters
-######## CHANGE THE FOLLOWING ###########
-server='myservername.database.windows.net'
-database='db_name'
-dbo_table='dbo.table_name'
-username='username@myservername'
-password='mypassword'
-driver= '{ODBC Driver 17 for SQL Server}'
-#########################################
-
-# Used to decode category predictions
-label_mapping = {
-    "Cash" : "1",
-    "Vacances" : "2",
-    "Alimentaire" : "3",
-    "Restaurants" : "4",
-    "Boutiques" : "5",
-    "Transports" : "6",
-    "Revenus" : "7",
-    "Jeux" : "8",
-    "Prelevements" : "9",
-    "Maison" : "10",
-    "Sante" : "11",
-    "Tabac" : "12",
-    "Loisir" : "13",
-    "Essence" : "14",
-    "Divers" : "15",
+import os
+
+# Azure SQL Database parameters
+######## CHANGE THE FOLLOWING ###########
+server='myservername.database.windows.net'
+database='db_name'
+dbo_table='dbo.table_name'
+username='username@myservername'
+password='mypassword'
+driver= '{ODBC Driver 17 for SQL Server}'
+#########################################
+
+# Storage backend: 'mssql' (Azure SQL database above) or 'sqlite' (local file, for offline use and benchmarks)
+storage_backend = 'mssql'
+# The SQLite backend works on a copy of the sample database, made on first use, so the tracked file is never written to
+sqlite_sample_database = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'visualisations', 'transactions.db')
+sqlite_database = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'transactions.db')
+sqlite_table = 'bsa_table'
+
+# Monthly totals per category, kept up to date by the loader and used by the aggregation API
+dbo_rollup_table = 'dbo.monthly_rollup'
+sqlite_rollup_table = 'bsa_monthly_rollup'
+
+# Database connections are pooled per worker: maximum number of connections, seconds to wait for a free one,
+# and age in seconds after which a connection is recycled (Azure SQL drops idle connections after 30 minutes)
+db_pool_size = 5
+db_pool_timeout = 30
+db_pool_recycle = 1500
+
+# Number of rows sent and committed per database round trip
+db_chunk_size = 500
+
+# 'insert' reports re-imported rows as failed duplicates, 'upsert' merges them on ID (updated or unchanged)
+db_load_mode = 'upsert'
+
+# OCR settings: number of processes per worker (None = number of CPUs divided by job_workers), rasterisation dpi and Tesseract language
+# ('fra' needs the tesseract-ocr-fra language data, installed in the Docker image)
+ocr_workers = None
+ocr_dpi = 200
+ocr_lang = 'fra'
+
+# Pages are binarised, deskewed by up to ocr_max_skew degrees (0 = no deskewing) and cropped to their text before OCR
+ocr_preprocess = True
+ocr_max_skew = 2.0
+
+# Tesseract page segmentation mode (6 = one uniform block, keeps each transaction on one line) and characters
+# it may output, '' for all (the whitelist is ignored by the LSTM engine of Tesseract 4.0, supported from 4.1)
+ocr_psm = 6
+ocr_whitelist = ("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                 "àâçéèêëîïôùûüÀÂÇÉÈÊËÎÏÔÙÛÜ.,:;/-+*()&%°€")
+
+# Read the embedded text of digital pdfs instead of running OCR, when it contains the statement markers below
+use_text_layer = True
+
+# Maximum size of the extracted text kept in the OCR cache, least recently used pages are evicted first
+ocr_cache_max_bytes = 200 * 1024 * 1024
+
+# Statements processed concurrently by a batch upload (ZIP archive or batch.py), their pages share the OCR processes
+batch_workers = 4
+
+# Maximum uncompressed size of one statement of a ZIP archive, larger members are skipped,
+# and of all its statements, larger archives are rejected
+zip_max_member_bytes = 20 * 1024 * 1024
+zip_max_total_bytes = 500 * 1024 * 1024
+
+# Background jobs (pdf processing): SQLite queue file, number of job worker processes started by worker.py,
+# seconds between two polls of an empty queue, and seconds without progress after which a running job is retried
+job_database = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'jobs.db')
+job_workers = 2
+job_poll_interval = 0.5
+job_stale_after = 600
+
+# Seconds without progress after which a progress stream sends a keepalive comment (detects closed connections)
+progress_keepalive = 15
+
+# Web workers import pandas, scikit-learn and the OCR modules on first use by a route, set to False to import them at boot
+lazy_imports = True
+
+# Metrics served on /metrics, shared by the web and job workers through a local SQLite file
+metrics_enabled = True
+metrics_database = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'metrics.db')
+# /metrics answers requests from the same host only, or requests sending this token (Authorization: Bearer <token>)
+metrics_token = None
+
+# Profiling (pyinstrument if installed, cProfile otherwise): requests called with ?profile=1, and every background job
+# Reports are written to app/profiles, leave disabled in production unless looking for a hot path
+profile_requests = False
+profile_jobs = False
+
+# Seconds after which an unused upload workspace is deleted
+workspace_ttl = 24 * 60 * 60
+
+# Markers around the transactions table of a statement
+statement_start = 'SOLDE PRECEDENT'
+statement_stop = 'NOUVEAU SOLDE'
+
+# Minimum prediction confidence, below which a transaction is categorised as "Other"
+category_threshold = 0.3
+
+# Categories counted as income, and transfers between own accounts counted neither as income nor spending
+income_categories = ['Revenus', 'Income']
+transfer_categories = ['Internal Transfer']
+
+# Category model retrained incrementally from the stored transactions (training.py): retrain after each upload
+# (a new version is only published when it scores at least as well as the model in use on held out rows),
+# and number of model versions kept in ml/models
+retrain_after_upload = False
+model_versions_kept = 5
+
+# Merchant lookup in front of the category model: minimum fuzzy match score (0-100), number of merchants
+# scored per lookup after the trigram prefilter, seconds after which the index is rebuilt from the stored transactions,
+# and minimum length of a merchant name matched fuzzily (shorter names only match exactly)
+merchant_fuzzy_threshold = 90
+merchant_candidates = 20
+merchant_index_ttl = 600
+merchant_min_length = 5
+
+# Used to decode category predictions
+label_mapping = {
+    "Cash" : "1",
+    "Vacances" : "2",
+    "Alimentaire" : "3",
+    "Restaurants" : "4",
+    "Boutiques" : "5",
+    "Transports" : "6",
+    "Revenus" : "7",
+    "Jeux" : "8",
+    "Prelevements" : "9",
+    "Maison" : "10",
+    "Sante" : "11",
+    "Tabac" : "12",
+    "Loisir" : "13",
+    "Essence" : "14",
+    "Divers" : "15",
 }
\ No newline at end of file
@@ -0,0 +1,144 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+from parameters import statement_start, statement_stop
+
+# Patterns and translation tables shared by every statement, compiled once
+TRANSACTION_LINE = re.compile(r'^\d\d/\d\d')
+DATE_IN_REFERENCE = re.compile(r'(\d+/\d+/\d+)')
+NUMBER_IN_REFERENCE = re.compile(r'(\d{4,10})')
+REFERENCE_NOISE = str.maketrans("", "", "-?!/;:_")
+REFERENCE_SEPARATORS = str.maketrans("", "", ",' ")
+THOUSANDS_SEPARATORS = str.maketrans("", "", " .\u00a0\u202f")
+
+# Amount printed at the end of a transaction line: optional thousands separators, decimal comma
+# e.g. "9,99", "152,06", "1.937,43", "1\u202f937,43", and "1 937,43" or "12 345,67" in a column
+# A space (or no-break space) only groups thousands when the amount starts a column, after a gap of two or more
+# spaces: otherwise "CB SHOP 750 125,00" would read the store number as thousands
+AMOUNT_GRAMMAR = (r'(?P<units>(?:^|(?<=\s\s))\d{1,3}(?:[ \u00a0]\d{3})+|\d{1,3}(?:[.\u202f]\d{3})+|\d+)'
+                  r',(?P<cents>\d{2})\s*$')
+AMOUNT = re.compile(r'(?:^|\s)' + AMOUNT_GRAMMAR)
+AMOUNT_WITH_SPACES = re.compile(r'(?:^|\s+)' + AMOUNT_GRAMMAR)
+# Group of 1 to 3 digits a single space before the amount, e.g. "2" in "CB SHOP 2 345,67": the thousands of the amount,
+# or a number of the reference. OCR text collapses the column gaps to one space, so it cannot tell them apart
+AMBIGUOUS_GROUP = re.compile(r'(?<=\S\s)(?P<group>\d{1,3})[ \u00a0](?=\d{3}(?:[ \u00a0]\d{3})*,\d{2}\s*$)')
+# Amount whose thousands are all separated by single spaces, how such a line is read without column layout
+SPACED_AMOUNT = re.compile(r'\s*(?P<units>\d{1,3}(?:[ \u00a0]\d{3})+),(?P<cents>\d{2})\s*$')
+
+# Column header of the layout text, used to tell debit amounts from credit amounts
+DEBIT_CREDIT_HEADER = re.compile(r'(D[ée]bit)\s{2,}(Cr[ée]dit)')
+DEBIT = -1
+CREDIT = 1
+UNKNOWN = 0
+
+
+def statement_lines(text):
+    """
+    Input: Text extracted from a statement
+    Output: pandas Series of the lines between the SOLDE PRECEDENT and NOUVEAU SOLDE markers
+    """
+    cut_text = text[(text.index(statement_start) + len(statement_start)):text.index(statement_stop)]
+    return pd.Series(cut_text.splitlines()[1:-1], dtype=object)
+
+def remove_first_match(references, pattern):
+    """
+    Remove every occurrence of the first match of a pattern from each reference
+    """
+    matches = references.str.extract(pattern, expand=False)
+    return pd.Series([reference if not isinstance(match, str) else reference.replace(match, "")
+                      for reference, match in zip(references, matches)], index=references.index, dtype=object)
+
+def amounts_to_cents(lines):
+    """
+    Parse the amount at the end of each line with the AMOUNT grammar
+    Output: Series of integer-valued cents, NaN where a line does not end with an amount
+    """
+    parts = lines.str.extract(AMOUNT, expand=True)
+    units = pd.to_numeric(parts['units'].str.translate(THOUSANDS_SEPARATORS), errors='coerce')
+    return units * 100 + pd.to_numeric(parts['cents'], errors='coerce')
+
+def ambiguous_groups(lines):
+    """
+    Output: Series of the digit group found a single space before the amount of each line (see AMBIGUOUS_GROUP),
+    NaN where there is none
+    """
+    return lines.str.extract(AMBIGUOUS_GROUP, expand=False)
+
+def header_boundary(line):
+    """
+    Input: Debit/Credit column header line of a layout text
+    Output: Character position separating the debit column from the credit column, NaN if the line is not a header
+    """
+    match = DEBIT_CREDIT_HEADER.search(line)
+    if not match:
+        return np.nan
+    # Amounts are right aligned under their header
+    return (match.end(1) + match.end(2)) / 2.0
+
+def amount_signs(text, lines):
+    """
+    Debit or credit sign of each line, from the column its amount ends in
+    Only layout text (pdf text layer) keeps the columns, OCR text gives UNKNOWN signs
+    """
+    before = [header_boundary(line) for line in text[:text.index(statement_start)].splitlines()]
+    before = [boundary for boundary in before if not np.isnan(boundary)]
+
+    # Headers are repeated on every page, each line uses the last header above it
+    boundaries = lines.map(header_boundary).ffill()
+    if before:
+        boundaries = boundaries.fillna(before[-1])
+
+    ends = lines.str.rstrip().str.len()
+    return pd.Series(np.select([boundaries.isnull(), ends > boundaries], [UNKNOWN, CREDIT], default=DEBIT),
+                     index=lines.index)
+
+def parse_statement(text, year, month):
+    """
+    Extract the transactions of one statement in a single vectorised pass over its lines
+    Input: Statement text, and the year and month of the statement (strings)
+    Output: Dataframe with date (dd/mm/yyyy), value (float), cents (integer), sign (DEBIT, CREDIT or UNKNOWN),
+    ambiguous (see below) and reference columns, one row per transaction line
+    A digit group a single space before the amount is read from the column layout when there is one: amounts start
+    after a column gap, so the group belongs to the reference. Without layout (OCR), it is read as the thousands
+    of the amount, as the larger value is the one that must not go unnoticed. Either way the row is flagged ambiguous
+    """
+    lines = statement_lines(text)
+    # Signs are read from the column positions, the other fields from lines starting with the date like OCR lines
+    signs = amount_signs(text, lines)
+    lines = lines.str.lstrip()
+    lines = lines[lines.str[-3:].str.contains(",", regex=False) & lines.str.contains(TRANSACTION_LINE)]
+
+    # If month is 12 in a January statement > display the previous year
+    previous_year = (lines.str[3:5] == "12") & (month == "01")
+    dates = lines.str[:5] + "/" + pd.Series(np.where(previous_year, str(int(year) - 1), year), index=lines.index)
+
+    details = lines.str[6:]
+    cents = amounts_to_cents(details)
+
+    groups = ambiguous_groups(details)
+    ambiguous = groups.notnull() & cents.notnull()
+    thousands = ambiguous & (signs.loc[lines.index] == UNKNOWN)
+    if ambiguous.any():
+        logging.warning("{} ambiguous amount(s), a digit group is a single space before them: {}".format(
+            int(ambiguous.sum()), "; ".join(details[ambiguous].str.strip())))
+    parts = details[thousands].str.extract(SPACED_AMOUNT, expand=True)
+    cents[thousands] = (pd.to_numeric(parts['units'].str.translate(THOUSANDS_SEPARATORS), errors='coerce') * 100
+                        + pd.to_numeric(parts['cents'], errors='coerce'))
+
+    references = details.str.replace(AMOUNT_WITH_SPACES, "", regex=True)
+    references[thousands] = details[thousands].str.replace(SPACED_AMOUNT, "", regex=True)
+    references = remove_first_match(references, DATE_IN_REFERENCE)
+    references = remove_first_match(references, NUMBER_IN_REFERENCE)
+    references = references.str.translate(REFERENCE_NOISE).str.strip().str.translate(REFERENCE_SEPARATORS)
+
+    return pd.DataFrame({
+        'date': dates.values,
+        'value': (cents / 100.0).values,
+        'cents': cents.values,
+        'sign': signs.loc[lines.index].values,
+        'ambiguous': ambiguous.values,
+        'reference': references.values,
+    }, columns=['date', 'value', 'cents', 'sign', 'ambiguous', 'reference'])
@@ -0,0 +1,90 @@
+import numpy as np
+from PIL import Image
+
+# Rows or columns with fewer dark pixels than this share of the page are scanning noise, not text
+MIN_INK = 0.002
+# Rows or columns darker than this share of the page are borders or rules, not text
+MAX_INK = 0.5
+# Maximum number of dark pixels sampled to estimate the skew
+SKEW_SAMPLES = 20000
+
+
+def grayscale(image):
+    """
+    Input: PIL image of a page, in any mode
+    Output: 2D uint8 array, 0 for black and 255 for white
+    """
+    if image.mode == 'L':
+        return np.asarray(image, dtype=np.uint8)
+    rgb = np.asarray(image.convert('RGB'), dtype=np.float32)
+    # ITU-R 601 luma, the weights PIL uses for its own 'L' conversion
+    return (rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114).astype(np.uint8)
+
+def otsu_threshold(pixels):
+    """
+    Input: 2D uint8 array
+    Output: Gray level separating text from background, maximising the variance between the two classes
+    """
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    weights = histogram / histogram.sum()
+    background = np.cumsum(weights)
+    means = np.cumsum(weights * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (means[-1] * background - means) ** 2 / (background * (1 - background))
+    return int(np.argmax(np.nan_to_num(variance)))
+
+def estimate_skew(ink, max_angle, step=0.1):
+    """
+    Projection profile method: text lines give the sharpest row histogram of the dark pixels at the skew angle
+    Input: 2D boolean array of the dark pixels, maximum angle and step in degrees
+    Output: Skew angle in degrees, positive when the lines go down to the right
+    """
+    ys, xs = np.nonzero(ink)
+    if len(ys) == 0:
+        return 0.0
+    stride = max(len(ys) // SKEW_SAMPLES, 1)
+    ys, xs = ys[::stride].astype(np.float64), xs[::stride].astype(np.float64)
+
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        rows = ys - xs * np.tan(np.radians(angle))
+        profile = np.bincount((rows - rows.min()).astype(np.int64)).astype(np.float64)
+        score = np.sum(profile ** 2)
+        if score > best_score:
+            best_angle, best_score = round(float(angle), 3), score
+    return best_angle
+
+def content_box(ink, padding):
+    """
+    Input: 2D boolean array of the dark pixels, and white border to keep around the text in pixels
+    Output: (top, bottom, left, right) of the text area, the whole page if no text is found
+    """
+    height, width = ink.shape
+    rows = ink.sum(axis=1)
+    columns = ink.sum(axis=0)
+    rows = np.nonzero((rows >= max(MIN_INK * width, 2)) & (rows <= MAX_INK * width))[0]
+    columns = np.nonzero((columns >= max(MIN_INK * height, 2)) & (columns <= MAX_INK * height))[0]
+    if len(rows) == 0 or len(columns) == 0:
+        return 0, height, 0, width
+    return (max(rows[0] - padding, 0), min(rows[-1] + padding + 1, height),
+            max(columns[0] - padding, 0), min(columns[-1] + padding + 1, width))
+
+def preprocess_page(image, max_skew=2.0, padding=20):
+    """
+    Prepare a rasterised page for Tesseract: grayscale, Otsu binarisation, deskewing and cropping to the text area
+    The statement markers stay on the page, only the margins and scanning borders around the table are cut
+    Input: PIL image, maximum skew corrected in degrees (0 to skip deskewing), and white border kept in pixels
+    Output: Black and white PIL image ('L' mode, 0 or 255)
+    """
+    pixels = grayscale(image)
+    threshold = otsu_threshold(pixels)
+    ink = pixels <= threshold
+
+    angle = estimate_skew(ink, max_skew) if max_skew else 0.0
+    if angle:
+        # Rotating the gray page then thresholding again keeps the character edges smooth
+        pixels = np.asarray(Image.fromarray(pixels).rotate(angle, resample=Image.BILINEAR, fillcolor=255), dtype=np.uint8)
+        ink = pixels <= threshold
+
+    top, bottom, left, right = content_box(ink, padding)
+    return Image.fromarray(np.where(ink[top:bottom, left:right], 0, 255).astype(np.uint8))
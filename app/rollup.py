@@ -0,0 +1,145 @@
+import logging
+from collections import defaultdict
+
+from parameters import income_categories, transfer_categories
+
+# Month of a transaction date, as yyyy-mm
+MONTH_SQL = {
+    'sqlite': "substr([Date], 1, 7)",
+    'mssql': "CONVERT(char(7), [Date], 126)",
+}
+GROUPS = ('month', 'year', 'category')
+
+
+def month_of(date):
+    """
+    Input: Transaction date, as a datetime or as an ISO formatted string (SQLite)
+    Output: yyyy-mm month of the date
+    """
+    return str(date)[:7]
+
+def category_type(category):
+    """
+    Output: 'income', 'transfer' or 'spending'
+    """
+    if category in income_categories:
+        return 'income'
+    if category in transfer_categories:
+        return 'transfer'
+    return 'spending'
+
+def rollup_deltas(rows, sign=1, deltas=None):
+    """
+    Input: Transaction rows in loader.COLUMNS order, sign -1 to remove them from the rollup
+    Output: Dictionary of (month, category): [total change, transactions change]
+    """
+    if deltas is None:
+        deltas = defaultdict(lambda: [0.0, 0])
+    for _, date, value, _, category, _ in rows:
+        if date is None:
+            continue
+        delta = deltas[(month_of(date), category or "Other")]
+        delta[0] += sign * float(value or 0.0)
+        delta[1] += sign
+    return deltas
+
+def create_rollup(cnxn, table, rollup, dialect):
+    """
+    Create and fill the rollup table from the transactions table, unless it already exists
+    The check, creation and fill run in one transaction holding a write lock, so that two processes
+    starting at the same time neither create the table twice nor see it before it is filled
+    """
+    def exists():
+        if dialect == 'sqlite':
+            return bool(cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rollup,)).fetchall())
+        return cursor.execute("SELECT OBJECT_ID(?)", (rollup,)).fetchone()[0] is not None
+
+    cursor = cnxn.cursor()
+    try:
+        if exists():
+            return
+        if dialect == 'sqlite':
+            cursor.execute("BEGIN IMMEDIATE")
+        else:
+            cursor.execute("EXEC sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Transaction'", (rollup,))
+        try:
+            # Another process may have built it while this one was waiting for the lock
+            if exists():
+                cnxn.commit()
+                return
+            logging.info("Building the {} rollup table from {}".format(rollup, table))
+            cursor.execute("CREATE TABLE {} (Month varchar(7) NOT NULL, Category varchar(255) NOT NULL, Total float NOT NULL, "
+                           "Transactions int NOT NULL, PRIMARY KEY (Month, Category))".format(rollup))
+            cursor.execute("""
+                INSERT INTO {rollup} (Month, Category, Total, Transactions)
+                SELECT {month}, COALESCE([Category], 'Other'), SUM(COALESCE([Value], 0)), COUNT(*) FROM {table}
+                WHERE [Date] IS NOT NULL
+                GROUP BY {month}, COALESCE([Category], 'Other')
+            """.format(rollup=rollup, table=table, month=MONTH_SQL[dialect]))
+            cnxn.commit()
+        except Exception:
+            cnxn.rollback()
+            # "Already exists" from a process that did not take the lock, the table only has to exist afterwards
+            if not exists():
+                raise
+    finally:
+        cursor.close()
+
+def apply_rollup(cnxn, rollup, deltas):
+    """
+    Add the changes of a load to the rollup table, in the transaction of the load
+    Uses UPDATE then INSERT so that it runs on every SQL Server and SQLite version
+    """
+    cursor = cnxn.cursor()
+    try:
+        for (month, category), (total, transactions) in deltas.items():
+            if transactions == 0 and abs(total) < 1e-9:
+                continue
+            cursor.execute("UPDATE {} SET Total = Total + ?, Transactions = Transactions + ? WHERE Month = ? AND Category = ?".format(rollup),
+                           (total, transactions, month, category))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO {} (Month, Category, Total, Transactions) VALUES (?, ?, ?, ?)".format(rollup),
+                               (month, category, total, transactions))
+        cursor.execute("DELETE FROM {} WHERE Transactions <= 0".format(rollup))
+    finally:
+        cursor.close()
+
+def aggregate(cnxn, rollup, by, year=None):
+    """
+    Input: by 'month', 'year' or 'category', optional year (yyyy) filter
+    Output: List of dictionaries sorted by group
+    - by month or year: spending, income and number of transactions, transfers being left out of both totals
+    - by category: type (income, spending or transfer), total and number of transactions
+    """
+    if by not in GROUPS:
+        raise ValueError("Unknown aggregation: {}".format(by))
+
+    cursor = cnxn.cursor()
+    try:
+        query = "SELECT Month, Category, Total, Transactions FROM {}".format(rollup)
+        if year is not None:
+            cursor.execute(query + " WHERE Month LIKE ?", (str(year) + "-%",))
+        else:
+            cursor.execute(query)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    groups = defaultdict(lambda: {'spending': 0.0, 'income': 0.0, 'transfer': 0.0, 'total': 0.0, 'transactions': 0})
+    for month, category, total, transactions in rows:
+        key = category if by == 'category' else month[:4] if by == 'year' else month
+        group = groups[key]
+        group[category_type(category)] += total
+        group['total'] += total
+        group['transactions'] += transactions
+
+    results = []
+    for key in sorted(groups):
+        group = groups[key]
+        if by == 'category':
+            results.append({'category': key, 'type': category_type(key), 'total': round(group['total'], 2),
+                            'transactions': group['transactions']})
+        else:
+            results.append({by: key, 'spending': round(group['spending'], 2), 'income': round(group['income'], 2),
+                            'transactions': group['transactions']})
+    return results
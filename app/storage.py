@@ -0,0 +1,253 @@
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+from parameters import (database, db_chunk_size, db_pool_recycle, db_pool_size,
+                        db_pool_timeout, dbo_rollup_table, dbo_table, driver,
+                        password, server, sqlite_database, sqlite_rollup_table,
+                        sqlite_sample_database, sqlite_table, storage_backend,
+                        username)
+from rollup import aggregate, create_rollup
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of DB-API connections, reused across requests of the same worker
+    Idle connections are pinged before being handed out and recycled after max_age seconds
+    """
+
+    def __init__(self, connect, size, timeout=db_pool_timeout, max_age=db_pool_recycle):
+        self._connect = connect
+        self.timeout = timeout
+        self.max_age = max_age
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a healthy connection, opening a new one only when no idle connection is available
+        The connection is rolled back and discarded if the caller fails with it
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError("No database connection available after {} seconds".format(self.timeout))
+        try:
+            cnxn, created = self._checkout()
+            try:
+                yield cnxn
+            except BaseException:
+                self._discard(cnxn)
+                raise
+            else:
+                self._idle.put((cnxn, created))
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        """
+        Output: (connection, creation time) of the first idle connection passing the health checks, or of a new one
+        """
+        # Connections inherited from the gunicorn master must not be shared with forked workers
+        if os.getpid() != self._pid:
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+
+        while True:
+            try:
+                cnxn, created = self._idle.get_nowait()
+            except queue.Empty:
+                logging.info("Opening a new database connection")
+                return self._connect(), time.time()
+            if time.time() - created > self.max_age:
+                self._discard(cnxn)
+            elif self._ping(cnxn):
+                return cnxn, created
+            else:
+                logging.warning("Dropping a stale database connection")
+                self._discard(cnxn)
+
+    def _ping(self, cnxn):
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, cnxn):
+        try:
+            cnxn.rollback()
+            cnxn.close()
+        except Exception as e:
+            logging.debug("Error when closing a discarded connection: {}".format(str(e)))
+
+
+class StorageBackend(object):
+    """
+    Database holding the transactions, monthly rollup and users tables
+    Subclasses provide the DB-API connection, the SQLAlchemy URI and the SQL dialect
+    """
+    dialect = None
+
+    def __init__(self, table, rollup_table, pool_size=db_pool_size):
+        self.table = table
+        self.rollup_table = rollup_table
+        self.pool = ConnectionPool(self._connect, pool_size)
+        self._rollup_ready = False
+        self._sign_ready = False
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def sqlalchemy_uri(self):
+        raise NotImplementedError
+
+    def connection(self):
+        """
+        Context manager borrowing a connection from the pool
+        """
+        return self.pool.connection()
+
+    def _ensure_rollup(self, cnxn):
+        # Built from the transactions table the first time, then updated incrementally by every load
+        if not self._rollup_ready:
+            create_rollup(cnxn, self.table, self.rollup_table, self.dialect)
+            self._rollup_ready = True
+
+    def _ensure_sign(self, cnxn):
+        # Transactions tables created before the Sign column get it on their first load
+        if not self._sign_ready:
+            from loader import ensure_sign_column
+            ensure_sign_column(cnxn, self.table)
+            self._sign_ready = True
+
+    def insert_transactions(self, df, chunk_size=db_chunk_size):
+        """
+        Output: Generator of (rows processed, succeeded, failed), see loader.insert_transactions
+        """
+        # The loader imports pandas, only needed once a table is loaded
+        from loader import insert_transactions
+        with self.connection() as cnxn:
+            self._ensure_sign(cnxn)
+            self._ensure_rollup(cnxn)
+            for progress in insert_transactions(cnxn, df, self.table, chunk_size, self.rollup_table):
+                yield progress
+
+    def upsert_transactions(self, df, chunk_size=db_chunk_size):
+        """
+        Output: Generator of (rows staged, counts), see loader.upsert_transactions
+        """
+        from loader import upsert_transactions
+        with self.connection() as cnxn:
+            self._ensure_sign(cnxn)
+            self._ensure_rollup(cnxn)
+            for progress in upsert_transactions(cnxn, df, self.table, self.dialect, chunk_size, self.rollup_table):
+                yield progress
+
+    def labelled_transactions(self):
+        """
+        Output: List of (ID, Reference, Category) of the stored transactions, the training data of the category model
+        """
+        with self.connection() as cnxn:
+            cursor = cnxn.cursor()
+            try:
+                cursor.execute("SELECT [ID], [Reference], [Category] FROM {} WHERE [Reference] IS NOT NULL AND [Category] IS NOT NULL".format(self.table))
+                rows = [tuple(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+            cnxn.rollback()
+            return rows
+
+    def aggregate(self, by, year=None):
+        """
+        Output: Spending and income by month or year, or totals by category, see rollup.aggregate
+        """
+        with self.connection() as cnxn:
+            self._ensure_rollup(cnxn)
+            results = aggregate(cnxn, self.rollup_table, by, year)
+            # Ends the read transaction, the connection goes back to the pool
+            cnxn.rollback()
+            return results
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Local SQLite file, used offline, in CI and for benchmarks (e.g. a copy of visualisations/transactions.db)
+    """
+    dialect = 'sqlite'
+
+    def __init__(self, path, table, rollup_table, pool_size=db_pool_size):
+        self.path = path
+        super(SQLiteBackend, self).__init__(table, rollup_table, pool_size)
+
+    def _connect(self):
+        cnxn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # WAL lets readers (dashboards, login) run while an upload is being written
+        cnxn.execute("PRAGMA journal_mode=WAL")
+        cnxn.execute("PRAGMA synchronous=NORMAL")
+        return cnxn
+
+    def sqlalchemy_uri(self):
+        return "sqlite:///" + self.path
+
+
+class MSSQLBackend(StorageBackend):
+    """
+    Azure SQL Database, reached through pyodbc
+    """
+    dialect = 'mssql'
+
+    def __init__(self, driver, server, database, username, password, table, rollup_table, pool_size=db_pool_size):
+        self.odbc_connect = "DRIVER={};SERVER={};PORT=1433;DATABASE={};UID={};PWD={}".format(
+            driver, server, database, username, password
+        )
+        self.sqlalchemy_params = urllib.parse.quote_plus("DRIVER={};SERVER={};DATABASE={};UID={};PWD={}".format(
+            driver, server, database, username, password
+        ))
+        super(MSSQLBackend, self).__init__(table, rollup_table, pool_size)
+
+    def _connect(self):
+        import pyodbc
+        return pyodbc.connect(self.odbc_connect)
+
+    def sqlalchemy_uri(self):
+        return "mssql+pyodbc:///?odbc_connect=%s" % self.sqlalchemy_params
+
+
+def copy_sample_database(path, sample=sqlite_sample_database):
+    """
+    Create the SQLite database from the sample database unless it exists
+    Workers can start together: the copy is made under another name and linked, which fails if another worker was first
+    """
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial = "{}.{}.tmp".format(path, os.getpid())
+    shutil.copy(sample, partial)
+    try:
+        os.link(partial, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(partial)
+
+def create_backend(name=storage_backend):
+    """
+    Input: Backend name, 'mssql' or 'sqlite'
+    Output: StorageBackend configured from parameters.py
+    """
+    if name == 'sqlite':
+        copy_sample_database(sqlite_database)
+        return SQLiteBackend(sqlite_database, sqlite_table, sqlite_rollup_table)
+    elif name == 'mssql':
+        return MSSQLBackend(driver, server, database, username, password, dbo_table, dbo_rollup_table)
+    raise ValueError("Unknown storage backend: {}".format(name))
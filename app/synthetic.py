@@ -0,0 +1,183 @@
+import argparse
+import os
+import random
+import sqlite3
+from datetime import date, timedelta
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from parameters import (sqlite_sample_database, sqlite_table,
+                        statement_start, statement_stop)
+
+# Monospace fonts keep the Débit/Crédit columns aligned on the rendered page, the default bitmap font is a last resort
+FONTS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf",
+    "DejaVuSansMono.ttf",
+]
+
+# Transaction line layout: date, reference, then the amount right aligned under the Débit or Crédit header
+DEBIT_END = 72
+CREDIT_END = 90
+COLUMN_HEADER = "Date   Détail des opérations en euros".ljust(DEBIT_END - 5) + "Débit" + "Crédit".rjust(CREDIT_END - DEBIT_END)
+
+# Kinds of transaction lines found on statements: (template, credit)
+TEMPLATES = [
+    ("CB {reference} FACT {day:02d}{month:02d}{year:02d}", False),
+    ("CB {reference} FACT {day:02d}{month:02d}{year:02d}", False),
+    ("CB {reference} FACT {day:02d}{month:02d}{year:02d}", False),
+    ("PRLV {reference}", False),
+    ("{reference}", False),
+    ("RETRAIT DAB {day:02d}-{month:02d}-{number:05d}", False),
+    ("VIR SEPA {reference}", True),
+]
+
+
+def statement_references(ml_folder, database=sqlite_sample_database, table=sqlite_table):
+    """
+    Output: List of references to draw transactions from: the training sentences of the category model
+    and the references of the sample transactions database, so that both the merchant index and the model are used
+    """
+    references = [str(reference) for reference in np.load(ml_folder + "sentences_train.npy", allow_pickle=True)]
+    if os.path.exists(database):
+        cnxn = sqlite3.connect(database)
+        try:
+            stored = [row[0] for row in cnxn.execute("SELECT DISTINCT [Reference] FROM {} WHERE [Reference] IS NOT NULL".format(table))]
+        finally:
+            cnxn.close()
+        # Drawn as often as the training sentences, there are far fewer of them
+        references += stored * (len(references) // max(len(stored), 1))
+    return [reference for reference in references if reference.strip()]
+
+def format_amount(cents):
+    """
+    Input: Amount in cents, e.g. 193743
+    Output: Amount as printed on statements, e.g. "1 937,43"
+    """
+    return "{:,}".format(cents // 100).replace(",", " ") + ",{:02d}".format(cents % 100)
+
+def transaction_line(day, month, label, cents, credit):
+    line = "{:02d}/{:02d}  {}".format(day, month, label)
+    amount = format_amount(cents)
+    end = CREDIT_END if credit else DEBIT_END
+    return line.ljust(end - len(amount)) + amount
+
+def generate_statement(statement_date, transactions, references, rng, lines_per_page=45):
+    """
+    Generate the layout text of a statement in the SOLDE PRECEDENT ... NOUVEAU SOLDE format of the sample statements
+    Input: Statement date, number of transactions, references to draw from, random.Random instance,
+    and number of transaction lines per page
+    Output: (list of page texts, list of expected (dd/mm/yyyy date, cents, credit, label) transactions)
+    """
+    start = statement_date - timedelta(days=30)
+    days = sorted(start + timedelta(days=rng.randint(1, 30)) for _ in range(transactions))
+    expected = []
+    lines = []
+    for day in days:
+        template, credit = rng.choice(TEMPLATES)
+        label = template.format(reference=rng.choice(references), day=day.day, month=day.month, year=day.year % 100,
+                                number=rng.randint(0, 99999))
+        cents = rng.randint(100000, 300000) if credit else int(rng.lognormvariate(7.5, 1.0))
+        lines.append(transaction_line(day.day, day.month, label, cents, credit))
+        expected.append((day.strftime("%d/%m/%Y"), cents, credit, label))
+
+    balance = rng.randint(0, 500000)
+    previous_date = start.strftime("%d/%m/%y")
+    closing = balance + sum(cents if credit else -cents for _, cents, credit, _ in expected)
+    title = "MR  DOE JOHN  - COMPTE  DE DEPOT  - N° 12345 12345 123456789"
+
+    pages = []
+    for page_number, first in enumerate(range(0, max(len(lines), 1), lines_per_page)):
+        page = []
+        if page_number == 0:
+            page += ["SYNTHESE   de vos comptes en euros", "COMPTE DE DEPOT  Solde au {}  {}".format(
+                statement_date.strftime("%d/%m/%y"), format_amount(abs(closing))), "", title, COLUMN_HEADER,
+                "{}  AU {}".format(statement_start, previous_date).ljust(CREDIT_END - 10) + format_amount(balance).rjust(10)]
+        else:
+            page += ["Relevé de vos comptes au {} - N° {}".format(statement_date.strftime("%d/%m/%Y"), page_number + 1),
+                     title, COLUMN_HEADER]
+        page += lines[first:first + lines_per_page]
+        pages.append(page)
+    # Like on the sample statements, a summary line separates the last transaction from the closing balance
+    pages[-1] += ["frais bancaires et cotisations pour un total de -0,00€",
+                  "{} {} AU {}".format(statement_stop, "CREDITEUR" if closing >= 0 else "DEBITEUR",
+                                       statement_date.strftime("%d/%m/%y")).ljust(CREDIT_END - 10) + format_amount(abs(closing)).rjust(10),
+                  "", "Page {}/{}".format(len(pages), len(pages))]
+    return ["\n".join(page) for page in pages], expected
+
+def load_font(size):
+    for font in FONTS:
+        try:
+            return ImageFont.truetype(font, size)
+        except (IOError, OSError):
+            continue
+    return ImageFont.load_default()
+
+def render_pdf(pages, pdf_path, dpi=200, skew=0.0, rng=None):
+    """
+    Render page texts as a scanned pdf (images only, no text layer) on A4 pages, so that it goes through OCR
+    Input: skew is the maximum angle in degrees each page is rotated by at random, like a sheet fed askew to a scanner
+    """
+    width, height = int(8.27 * dpi), int(11.69 * dpi)
+    margin = dpi // 2
+    # The widest line has to fit between the margins
+    font = load_font(int((width - 2 * margin) / (0.6 * (CREDIT_END + 2))))
+    line_height = int(font.getbbox("Ag")[3] * 1.3) if hasattr(font, "getbbox") else int(font.getsize("Ag")[1] * 1.3)
+    images = []
+    for page in pages:
+        image = Image.new("L", (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        for number, line in enumerate(page.splitlines()):
+            draw.text((margin, margin + number * line_height), line, fill=0, font=font)
+        if skew:
+            image = image.rotate((rng or random).uniform(-skew, skew), resample=Image.BILINEAR, fillcolor=255)
+        images.append(image)
+    images[0].save(pdf_path, "PDF", resolution=float(dpi), save_all=True, append_images=images[1:])
+
+def generate_statements(folder, statements, transactions, ml_folder, seed=0, first_month=(2020, 1),
+                        lines_per_page=45, pdf=True, skew=0.0):
+    """
+    Write synthetic statements to a folder, one per month starting from first_month (no clash with the IDs
+    of the sample database), named like the real ones so that the statement date is read from the file name
+    Each statement is written as its text (what OCR or the text layer gives) and, if pdf, as a scanned pdf
+    with pages rotated by up to skew degrees
+    Output: List of dictionaries with the pdf path, text path, page count and expected transactions of each statement
+    """
+    rng = random.Random(seed)
+    references = statement_references(ml_folder)
+    os.makedirs(folder, exist_ok=True)
+    generated = []
+    year, month = first_month
+    for _ in range(statements):
+        statement_date = date(year, month, 19)
+        name = "RELEVES_MR DOE JOHN_{}".format(statement_date.strftime("%Y%m%d"))
+        pages, expected = generate_statement(statement_date, transactions, references, rng, lines_per_page)
+
+        text_path = os.path.join(folder, name + ".txt")
+        with open(text_path, "w", encoding="utf-8") as f:
+            f.write("".join("\n" + page for page in pages))
+        pdf_path = os.path.join(folder, name + ".pdf")
+        if pdf:
+            render_pdf(pages, pdf_path, skew=skew, rng=rng)
+        generated.append({'pdf_path': pdf_path if pdf else None, 'text_path': text_path,
+                          'pages': len(pages), 'transactions': expected})
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic bank statements (text and scanned pdf)")
+    parser.add_argument("folder", help="Output folder")
+    parser.add_argument("-n", "--statements", type=int, default=3, help="Number of statements, one per month")
+    parser.add_argument("-t", "--transactions", type=int, default=60, help="Transactions per statement")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--no-pdf", action="store_true", help="Only write the statement texts")
+    parser.add_argument("--skew", type=float, default=0.0, help="Maximum rotation of the scanned pages, in degrees")
+    args = parser.parse_args()
+
+    ml_folder = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
+    for statement in generate_statements(args.folder, args.statements, args.transactions, ml_folder, args.seed,
+                                          pdf=not args.no_pdf, skew=args.skew):
+        print("{} ({} pages, {} transactions)".format(statement['pdf_path'] or statement['text_path'], statement['pages'],
+                                                      len(statement['transactions'])))
@@ -0,0 +1,46 @@
+from functions import statement_to_df
+from merchants import MerchantIndex, merchant_key, normalise_reference
+from parameters import statement_start, statement_stop
+from synthetic import COLUMN_HEADER, transaction_line
+
+
+def parsed_references(*labels):
+    """
+    Output: References of statement lines as stored, e.g. "CB INTERMARCHE FACT 211216" gives "CBINTERMARCHEFACT"
+    """
+    lines = [COLUMN_HEADER, "{}  AU 19/12/16".format(statement_start).ljust(80) + "1 481,88"]
+    lines += [transaction_line(21, 12, label, 1399, False) for label in labels]
+    # Like on the statements, a summary line separates the last transaction from the closing balance
+    lines += ["frais bancaires et cotisations pour un total de -0,00€",
+              "{} CREDITEUR AU 19/01/17".format(statement_stop).ljust(80) + "238,52"]
+    return list(statement_to_df("\n".join(lines), "statement_20170119.txt")['reference'])
+
+STORED = parsed_references("CB CARREFOUR FACT 201216", "CB INTERMARCHE FACT 211216", "PRLV FREE MOBILE",
+                           "CB SNCF INTERNET FACT 020117", "CB BLIZZARD ENTERT FACT 020117", "CB EDF FACT 020117")
+ENTRIES = list(zip(STORED, ["Alimentaire", "Alimentaire", "Prelevements", "Transports", "Jeux", "Logement"]))
+
+
+def index():
+    return MerchantIndex(lambda: ENTRIES)
+
+def lookups(*labels):
+    merchants = index()
+    return [merchants.lookup(reference) for reference in parsed_references(*labels)]
+
+def test_keys():
+    assert STORED[:3] == ["CBCARREFOURFACT", "CBINTERMARCHEFACT", "PRLVFREEMOBILE"]
+    assert normalise_reference("CARREFMARKETDAC 0607") == "CARREFMARKETDAC"
+    assert merchant_key("CBCARREFOURMARKETFACT") == "CARREFOURMARKET"
+    assert merchant_key("PRLVSEPAFREEMOBILE") == "FREEMOBILE"
+
+def test_exact():
+    assert lookups("CB CARREFOUR FACT 070117", "CB INTERMARCHE FACT 211216") == [("Alimentaire", "exact")] * 2
+
+def test_prefixed_and_suffixed_variants():
+    assert lookups("CB CARREFOUR MARKET FACT 201216", "CB INTERMARCHE EXPRESS FACT 211216",
+                   "PRLV SEPA FREE MOBILE", "CB SNCF INTERNET PARIS FACT 0101") == [
+        ("Alimentaire", "fuzzy"), ("Alimentaire", "fuzzy"), ("Prelevements", "fuzzy"), ("Transports", "fuzzy")]
+
+def test_unrelated_merchants():
+    assert lookups("CB LECLERC FACT 201216", "PRLV SEPA EDF CLIENTS", "CB FACT 201216",
+                   "CB AMAZON EU FACT 0101", "CB CREDIT FRANCE FACT 0101") == [(None, None)] * 5
@@ -0,0 +1,199 @@
+import os
+import random
+import re
+from datetime import date
+
+import pandas as pd
+
+from functions import statement_to_df, statements_to_table
+from parsing import (AMOUNT_WITH_SPACES, CREDIT, DEBIT, UNKNOWN, amounts_to_cents,
+                     parse_statement)
+from synthetic import generate_statement, statement_references
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ML_FOLDER = os.path.join(APP_FOLDER, "ml/")
+SAMPLE_STATEMENT = os.path.join(APP_FOLDER, "tests", "data", "statement_20170119.txt")
+
+
+# Row by row parser replaced by parse_statement, kept as the reference its output is compared with
+def filter_ref_col(reference):
+    if re.search(r'(\d+/\d+/\d+)', reference):
+        match = re.search(r'(\d+/\d+/\d+)', reference).group(1)
+        reference = reference.replace(match, "")
+    if re.search(r'(\d{4,10})', reference):
+        match = re.search(r'(\d{4,10})', reference).group(1)
+        reference = reference.replace(match, "")
+    for char in reference:
+        if char in "-?!/;:_":
+            reference = reference.replace(char, "")
+    return reference
+
+def extract_amount(reference):
+    if "." in reference:
+        reference = reference.replace(".", " ")
+    if reference[-5] == " ":
+        return reference[-5:]
+    elif reference[-6] == " ":
+        return reference[-6:]
+    elif reference[-7] == " ":
+        if re.search(r'(\b(\d){1,2}.?\d{3},[0-9]{2})', reference):
+            return re.search(r'(\b(\d){1,2}.?\d{1,3},[0-9]{2})', reference).group(1)
+        else:
+            return reference[-6:]
+
+def row_loop_parse(text, filename):
+    """
+    Output: Dataframe with ID, date, amount string, reference and line columns, as the row loop built them
+    """
+    year = filename[-12:-8]
+    month = filename[-8:-6]
+    dates, values, references, lines = [], [], [], []
+    cut_text = text[(text.index('SOLDE PRECEDENT') + len('SOLDE PRECEDENT')):text.index('NOUVEAU SOLDE')]
+    for line in cut_text.splitlines()[1:-1]:
+        if "," in line[-3:] and re.search(r'^(\d\d/\d\d)', line):
+            if line[3:5] == "12" and month == "01":
+                dates.append(line[:5] + "/" + str(int(year) - 1))
+            else:
+                dates.append(line[:5] + "/" + year)
+            lines.append(line)
+            try:
+                filtered_ref = filter_ref_col(line[6:])
+                value = extract_amount(filtered_ref)
+                values.append(str(value).strip())
+            except Exception:
+                values.append("0,00")
+            try:
+                filtered_ref = filtered_ref.replace(value, "")
+                references.append(str(filtered_ref).strip())
+            except Exception:
+                references.append("ERROR")
+
+    df = pd.DataFrame({'date': dates, 'value': values, 'reference': references, 'line': lines})
+    df["date"] = pd.to_datetime(df["date"], format='%d/%m/%Y', errors='coerce')
+    df['id'] = [year + month + str(index + 1).zfill(2) for index in df.index]
+    df = df[~df['date'].isnull()]
+    df['reference'] = [''.join(char for char in reference if char not in ",' ") for reference in df['reference']]
+    return df
+
+def amount_value(amount, line):
+    """
+    Output: Amount string found by the row loop as a number, None if it is not a valid amount
+    The row loop kept amounts as strings, and sometimes took them from the reference ("... 70,00)  1 685,99")
+    or from the previous line: only the amount the line ends with is valid
+    """
+    if not line.rstrip().endswith(amount):
+        return None
+    try:
+        return float(amount.replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+
+def cents_of(*lines):
+    return list(amounts_to_cents(pd.Series(lines, dtype=object)))
+
+def test_amounts():
+    assert cents_of("CB SHOP 9,99", "CB SHOP 152,06", "1.937,43", "CB SHOP 12.345,67") == [999, 15206, 193743, 1234567]
+
+def test_thin_space_groups_thousands():
+    assert cents_of("VIR SEPA 1 937,43") == [193743]
+
+def test_space_groups_thousands_after_a_column_gap():
+    assert cents_of("VIR SEPA      1 937,43", "VIR SEPA  12 345,67") == [193743, 1234567]
+
+def test_number_in_reference_is_not_thousands():
+    assert cents_of("REF 750 125,00", "CB SHOP 750 125,00", "CB SHOP 2 345,67") == [12500, 12500, 34567]
+    references = pd.Series(["REF 750 125,00"], dtype=object).str.replace(AMOUNT_WITH_SPACES, "", regex=True)
+    assert list(references) == ["REF 750"]
+
+def test_line_without_amount():
+    assert pd.isnull(cents_of("CB SHOP")[0])
+
+STATEMENT = """
+Date   Détail des opérations en euros                             Débit            Crédit
+SOLDE PRECEDENT AU 19/12/16                                                      1 000,00
+20/12  CB SHOP 750 FACT 191216                                   125,00
+21/12  VIR SEPA EMPLOYER                                                       1 937,43
+frais bancaires et cotisations pour un total de -0,00€
+NOUVEAU SOLDE CREDITEUR AU 19/01/17                                              2 812,43
+"""
+
+def test_parse_statement():
+    df = parse_statement(STATEMENT, "2017", "01")
+    assert list(df['date']) == ["20/12/2016", "21/12/2016"]
+    assert list(df['cents']) == [12500, 193743]
+    assert list(df['sign']) == [DEBIT, CREDIT]
+    assert list(df['reference']) == ["CBSHOP750FACT", "VIRSEPAEMPLOYER"]
+
+def test_indented_header_keeps_the_columns():
+    # A header with only the Débit and Crédit columns starts with spaces in layout text, they place the columns
+    text = re.sub(r'^Date.*?(?=Débit)', lambda match: " " * len(match.group(0)), STATEMENT, flags=re.MULTILINE)
+    df = parse_statement(text, "2017", "01")
+    assert list(df['cents']) == [12500, 193743]
+    assert list(df['sign']) == [DEBIT, CREDIT]
+    assert list(df['reference']) == ["CBSHOP750FACT", "VIRSEPAEMPLOYER"]
+
+def test_sign_reaches_the_table(monkeypatch):
+    monkeypatch.setattr("functions.classify_references", lambda references, ml_folder: ["Other"] * len(references))
+    df = parse_statement(STATEMENT, "2017", "01")
+    df['id'] = ["20170101", "20170102"]
+    table = statements_to_table([df], ML_FOLDER)
+    assert list(table.columns) == ['ID', 'Date', 'Value', 'Sign', 'Category', 'Reference', 'Ambiguous']
+    assert list(table['Sign']) == [DEBIT, CREDIT]
+    assert list(table['Value']) == [125.0, 1937.43]
+    assert list(table['Ambiguous']) == [False, False]
+
+# OCR text: the columns are gone and every gap is a single space
+OCR_STATEMENT = """
+Date Détail des opérations en euros Débit Crédit
+SOLDE PRECEDENT AU 19/12/16 1 000,00
+20/12 CB SHOP 2 345,67
+20/12 VIR SEPA EMPLOYER 1 937 430,00
+21/12 CB SHOP 1750 125,00
+22/12 CB SHOP 9,99
+frais bancaires et cotisations pour un total de -0,00€
+NOUVEAU SOLDE CREDITEUR AU 19/01/17 2 812,43
+"""
+
+def test_ocr_digit_group_before_amount_is_flagged(caplog):
+    df = parse_statement(OCR_STATEMENT, "2017", "01")
+    # Read as thousands rather than dropped, and flagged for review
+    assert list(df['cents']) == [234567, 193743000, 12500, 999]
+    assert list(df['ambiguous']) == [True, True, False, False]
+    assert list(df['sign']) == [UNKNOWN] * 4
+    assert list(df['reference']) == ["CBSHOP", "VIRSEPAEMPLOYER", "CBSHOP", "CBSHOP"]
+    assert "2 ambiguous amount(s)" in caplog.text
+
+def test_layout_digit_group_before_amount_is_flagged():
+    # With columns an amount starts after a gap, the digit group a single space before it belongs to the reference
+    text = STATEMENT.replace("CB SHOP 750 FACT 191216                                   125,00",
+                             "CB SHOP 750 FACT 191216 7 125,00")
+    df = parse_statement(text, "2017", "01")
+    assert list(df['cents']) == [12500, 193743]
+    assert list(df['sign']) == [DEBIT, CREDIT]
+    assert list(df['ambiguous']) == [True, False]
+    assert list(df['reference']) == ["CBSHOP750FACT7", "VIRSEPAEMPLOYER"]
+
+def assert_same_as_row_loop(text, filename):
+    expected = row_loop_parse(text, filename).reset_index(drop=True)
+    parsed = statement_to_df(text, filename).reset_index(drop=True)
+    assert len(expected) > 0
+    assert list(parsed['id']) == list(expected['id'])
+    assert list(parsed['date']) == list(expected['date'])
+    for value, reference, row in zip(parsed['value'], parsed['reference'], expected.itertuples()):
+        if amount_value(row.value, row.line) is not None:
+            assert round(value, 2) == amount_value(row.value, row.line)
+            assert reference == row.reference
+
+def test_sample_statement_matches_row_loop():
+    with open(SAMPLE_STATEMENT, encoding="utf-8") as f:
+        text = f.read()
+    assert_same_as_row_loop(text, os.path.basename(SAMPLE_STATEMENT))
+
+def test_synthetic_statements_match_row_loop():
+    references = statement_references(ML_FOLDER)
+    for seed in range(5):
+        statement_date = date(2020, 1 + seed, 19)
+        pages, _ = generate_statement(statement_date, 80, references, random.Random(seed))
+        assert_same_as_row_loop("".join("\n" + page for page in pages),
+                                "RELEVES_{}.txt".format(statement_date.strftime("%Y%m%d")))
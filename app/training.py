@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.naive_bayes import MultinomialNB
+
+from classifier import (CURRENT_MODEL, FALLBACK_CATEGORY, MODELS_FOLDER,
+                        classify_references, dump_model, get_registry,
+                        load_model, predict_categories)
+from parameters import category_threshold, label_mapping, model_versions_kept
+
+# Rows per partial_fit call when training from scratch
+TRAINING_CHUNK = 10000
+
+
+def make_vectorizer():
+    """
+    Stateless vectorizer: character n-grams hashed into a fixed space, so no vocabulary has to be refitted
+    Raw counts (no sign flipping, no normalisation) as required by MultinomialNB
+    """
+    return HashingVectorizer(analyzer='char_wb', ngram_range=(3, 5), n_features=2 ** 16,
+                             alternate_sign=False, norm=None, lowercase=True)
+
+def training_rows(rows):
+    """
+    Input: (ID, Reference, Category) rows of the transactions store
+    Output: Dictionary of ID: (reference, category), without the rows categorised as the fallback category
+    """
+    return {str(transaction_id): (str(reference), str(category)) for transaction_id, reference, category in rows
+            if reference and category and category != FALLBACK_CATEGORY}
+
+def held_out(transaction_id):
+    """
+    Deterministic split on the transaction ID: a fifth of the stored rows is never trained on,
+    and scores every new model version before it is published
+    The store does not tell user corrections from the categories the model predicted, so most held out
+    categories are labels of earlier model versions: the score is an agreement with them, not an accuracy
+    """
+    return int(hashlib.md5(transaction_id.encode()).hexdigest(), 16) % 5 == 0
+
+def seed_rows(ml_folder):
+    """
+    Original training corpus (sentences_train.npy), labelled by the original model where it is confident
+    Every model trained from scratch starts from it, so the stored transactions only add to what the original model knew
+    Output: List of (reference, category)
+    """
+    registry = get_registry(ml_folder)
+    vectorizer, model = registry.original()
+    references = [str(reference) for reference in np.load(registry.vocabulary_path, allow_pickle=True)]
+    categories = predict_categories(vectorizer, model, references)
+    return [(reference, category) for reference, category in zip(references, categories) if category != FALLBACK_CATEGORY]
+
+def evaluate(vectorizer, model, rows):
+    """
+    Output: Share of (reference, category) rows a model predicts the category of
+    """
+    return accuracy(predict_categories(vectorizer, model, [reference for reference, _ in rows]),
+                    [category for _, category in rows])
+
+def models_folder(ml_folder):
+    return os.path.join(ml_folder, MODELS_FOLDER)
+
+def load_artifact(ml_folder):
+    """
+    Output: Current versioned model artifact, None if the original model is still in use
+    """
+    current_path = os.path.join(models_folder(ml_folder), CURRENT_MODEL)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as f:
+        model_path = os.path.join(models_folder(ml_folder), f.read().strip())
+    if model_path.endswith(".sav"):
+        # Versions saved before the joblib format
+        with open(model_path, 'rb') as artifact:
+            return pickle.load(artifact)
+    with open(os.path.splitext(model_path)[0] + ".state", 'rb') as state:
+        artifact = pickle.load(state)
+    # Not memory mapped: partial_fit updates the model arrays in place
+    artifact['vectorizer'], artifact['model'] = load_model(model_path, mmap_mode=None)
+    return artifact
+
+def save_artifact(ml_folder, artifact):
+    """
+    Write a new model version, then point current.txt to it so that every worker hot swaps to it
+    The vectorizer and model go to a joblib file memory mapped by the workers, the training state
+    (trained rows) to a pickle only read by the next training
+    Only the last model_versions_kept versions are kept
+    """
+    folder = models_folder(ml_folder)
+    name = "model_v{:04d}".format(artifact['version'])
+    state = {key: value for key, value in artifact.items() if key not in ('vectorizer', 'model')}
+    with open(os.path.join(folder, name + ".state.tmp"), 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(os.path.join(folder, name + ".state.tmp"), os.path.join(folder, name + ".state"))
+    filename = name + ".joblib"
+    dump_model(os.path.join(folder, filename), artifact['vectorizer'], artifact['model'])
+
+    # Atomic switch, workers never read a partially written pointer
+    with open(os.path.join(folder, CURRENT_MODEL + ".tmp"), 'w') as f:
+        f.write(filename)
+    os.replace(os.path.join(folder, CURRENT_MODEL + ".tmp"), os.path.join(folder, CURRENT_MODEL))
+
+    versions = sorted(set(name.split(".")[0] for name in os.listdir(folder) if name.startswith("model_v")))
+    for version in versions[:-model_versions_kept]:
+        for name in os.listdir(folder):
+            if name.split(".")[0] == version:
+                os.remove(os.path.join(folder, name))
+    logging.info("Category model version {} saved".format(artifact['version']))
+
+def fit_model(vectorizer, items, classes):
+    """
+    Train a new model from scratch on (reference, category) items, in chunks of rows
+    """
+    model = MultinomialNB(alpha=0.1)
+    for start in range(0, len(items), TRAINING_CHUNK):
+        chunk = items[start:start + TRAINING_CHUNK]
+        model.partial_fit(vectorizer.transform([reference for reference, _ in chunk]),
+                          [category for _, category in chunk], classes=classes)
+    return model
+
+def update_model(model, vectorizer, removed, added):
+    """
+    Apply changes to a trained model with a single partial_fit call
+    Removed rows (previous version of corrected rows, deleted rows) are unlearnt with a weight of -1:
+    naive Bayes counts are additive, so the result is the model a full retraining would give
+    """
+    rows = removed + added
+    weights = np.array([-1.0] * len(removed) + [1.0] * len(added))
+    model.partial_fit(vectorizer.transform([reference for reference, _ in rows]),
+                      [category for _, category in rows], sample_weight=weights)
+    return model
+
+def train(rows, previous=None, full=False, seed=()):
+    """
+    Input: (ID, Reference, Category) rows of the transactions store, the current model artifact if any,
+    and the (reference, category) rows every model trained from scratch starts from (see seed_rows)
+    Output: New model artifact, or None when nothing changed since the previous version
+    The previous model is updated with the new and corrected rows only, unless a full retraining is requested,
+    new categories appeared (the classes of a partial_fit model are fixed) or the previous model was not seeded
+    """
+    trained = training_rows(rows)
+    categories = set(category for _, category in trained.values())
+
+    if (previous is None or full or not categories.issubset(previous['model'].classes_)
+            or previous.get('seeded') is None):
+        vectorizer = make_vectorizer()
+        classes = sorted(categories | set(category for _, category in seed) | set(label_mapping))
+        start = time.time()
+        model = fit_model(vectorizer, list(seed) + list(trained.values()), classes)
+        mode, changed, seeded = 'full', len(trained), len(seed)
+    else:
+        vectorizer, model = previous['vectorizer'], previous['model']
+        before = previous['trained']
+        removed = [before[transaction_id] for transaction_id in before if trained.get(transaction_id) != before[transaction_id]]
+        added = [trained[transaction_id] for transaction_id in trained if before.get(transaction_id) != trained[transaction_id]]
+        if not removed and not added:
+            logging.info("Category model is up to date")
+            return None
+        start = time.time()
+        model = update_model(model, vectorizer, removed, added)
+        mode, changed, seeded = 'incremental', len(removed) + len(added), previous['seeded']
+
+    logging.info("Category model trained ({}, {} rows) in {:.2f}s".format(mode, changed, time.time() - start))
+    return {
+        'version': previous['version'] + 1 if previous else 1,
+        'created': time.time(),
+        'mode': mode,
+        'vectorizer': vectorizer,
+        'model': model,
+        'trained': trained,
+        'seeded': seeded,
+    }
+
+def retrain(ml_folder, storage, full=False):
+    """
+    Train a new model version from the transactions store, one training at a time per ML folder
+    The new version is only published if it agrees with the stored categories of the held out rows at least as much
+    as the model in use. This catches a new version forgetting what was learnt, not a gain in accuracy: the model in use
+    predicted most of these categories itself (see held_out)
+    Output: New version number, None if the model was already up to date or the new version was not published
+    """
+    labelled = training_rows(storage.labelled_transactions())
+    test_rows = [labelled[transaction_id] for transaction_id in sorted(labelled) if held_out(transaction_id)]
+    train_rows = [(transaction_id, reference, category) for transaction_id, (reference, category) in labelled.items()
+                  if not held_out(transaction_id)]
+
+    os.makedirs(models_folder(ml_folder), exist_ok=True)
+    with open(os.path.join(models_folder(ml_folder), ".lock"), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        previous = load_artifact(ml_folder)
+        # Scored before training, incremental updates change the previous model in place
+        if previous is not None:
+            vectorizer, model = previous['vectorizer'], previous['model']
+        else:
+            vectorizer, model = get_registry(ml_folder).original()
+        current_accuracy = evaluate(vectorizer, model, test_rows)
+        artifact = train(train_rows, previous, full, seed_rows(ml_folder))
+        if artifact is None:
+            return None
+
+        # Saved as 'accuracy' in the artifact, it is the agreement with the stored categories
+        artifact['accuracy'] = evaluate(artifact['vectorizer'], artifact['model'], test_rows)
+        if not test_rows or artifact['accuracy'] < current_accuracy:
+            logging.warning("Category model version {} not published: held-out agreement {:.1%}, {:.1%} for the model "
+                            "in use ({} held-out rows)".format(artifact['version'], artifact['accuracy'], current_accuracy,
+                                                               len(test_rows)))
+            return None
+        logging.info("Held-out agreement {:.1%}, {:.1%} for the model in use".format(artifact['accuracy'], current_accuracy))
+        save_artifact(ml_folder, artifact)
+        return artifact['version']
+
+def accuracy(predictions, categories):
+    return float(np.mean(np.asarray(predictions, dtype=object) == np.asarray(categories, dtype=object))) if len(categories) else 0.0
+
+def benchmark(ml_folder, rows, corrections=100):
+    """
+    Compare the model in use with the incremental model on a held out fifth of the stored transactions
+    Output: Dictionary of accuracies and timings
+    """
+    labelled = training_rows(rows)
+    test_ids = set(transaction_id for transaction_id in labelled if held_out(transaction_id))
+    train_rows = [(i, r, c) for i, (r, c) in labelled.items() if i not in test_ids]
+    test_references = [labelled[i][0] for i in sorted(test_ids)]
+    test_categories = [labelled[i][1] for i in sorted(test_ids)]
+
+    results = {'train_rows': len(train_rows), 'test_rows': len(test_ids)}
+
+    start = time.time()
+    predictions = classify_references(test_references, ml_folder, category_threshold)
+    results['current_predict_s'] = time.time() - start
+    results['current_accuracy'] = accuracy(predictions, test_categories)
+
+    seed = seed_rows(ml_folder)
+    start = time.time()
+    artifact = train(train_rows, seed=seed)
+    results['full_training_s'] = time.time() - start
+    vectorizer, model = artifact['vectorizer'], artifact['model']
+
+    start = time.time()
+    predictions = predict_categories(vectorizer, model, test_references)
+    results['incremental_predict_s'] = time.time() - start
+    results['incremental_accuracy'] = accuracy(predictions, test_categories)
+    # Sample references often contain their category name, agreement with the original model on its own corpus
+    # shows whether the new model kept what the original one knew
+    results['original_agreement'] = evaluate(vectorizer, model, seed)
+
+    # Incremental update: a batch of user corrections, relabelling rows to another known category
+    corrected = train_rows[:corrections]
+    classes = list(model.classes_)
+    corrected = [(i, r, classes[(classes.index(c) + 1) % len(classes)]) for i, r, c in corrected] + train_rows[corrections:]
+    start = time.time()
+    train(corrected, artifact)
+    results['incremental_update_s'] = time.time() - start
+    results['corrections'] = min(corrections, len(train_rows))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrain the category model from the stored transactions")
+    parser.add_argument("--full", action="store_true", help="Train from scratch instead of updating the current version")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the current model with the incremental model, without saving")
+    parser.add_argument("--backend", help="Storage backend, 'mssql' or 'sqlite' (default: parameters.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    from storage import create_backend
+    storage = create_backend(args.backend) if args.backend else create_backend()
+    ml_folder = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
+
+    if args.benchmark:
+        for name, value in sorted(benchmark(ml_folder, storage.labelled_transactions()).items()):
+            print("{:<24}{}".format(name, round(value, 4) if isinstance(value, float) else value))
+    else:
+        version = retrain(ml_folder, storage, args.full)
+        print("Model version {}".format(version) if version else "Model already up to date")
@@ -0,0 +1,173 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+from batch import ingest_statements
+from classifier import get_registry
+from functions import load_table, save_table
+from jobs import DONE, FAILED, JobQueue
+from merchants import MerchantIndex
+from metrics import flush_metrics, observe, save_profile, start_profile
+from ocr_cache import OCRCache
+from parameters import (db_load_mode, job_database, job_poll_interval,
+                        job_stale_after, job_workers, ocr_cache_max_bytes,
+                        profile_jobs, retrain_after_upload)
+from storage import create_backend
+from training import retrain
+
+ML_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/ml/"
+CACHE_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/cache/"
+PROFILE_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/profiles/"
+
+# Storage backend of the worker process, created on first use
+_storage = None
+
+def worker_storage():
+    global _storage
+    if _storage is None:
+        _storage = create_backend()
+    return _storage
+
+# Merchant categories of the stored transactions, looked up before the category model
+merchants = MerchantIndex(lambda: [(reference, category) for _, reference, category in worker_storage().labelled_transactions()])
+
+
+def process_statements(jobs, job_id, payload, cache):
+    """
+    Extract, parse and categorise the transactions of the pdf statements of a job, and save the table in its workspace
+    Input: payload with the pdf_paths to process and the workspace
+    Output: Job result, with the number of transactions
+    """
+    progress = 0
+    for done, total, df in ingest_statements(payload['pdf_paths'], ML_FOLDER, cache, merchants=merchants):
+        # The last percent is kept for the table creation, progress is only written when it changes
+        if df is None and min(int(100 * done / total), 99) > progress:
+            progress = min(int(100 * done / total), 99)
+            jobs.set_progress(job_id, progress)
+
+    if df.empty:
+        raise ValueError("No transaction could be extracted from {}".format(", ".join(payload['pdf_paths'])))
+
+    save_table(df, payload['workspace'])
+    logging.info("{} transactions saved to {}".format(df.shape[0], payload['workspace']))
+    logging.info("Merchant lookup: {}".format(merchants.metrics()))
+    return {'rows': int(df.shape[0]), 'merchants': merchants.metrics()}
+
+def load_transactions(jobs, job_id, payload, cache):
+    """
+    Load the table of a workspace into the transactions database
+    Rows failing to load are counted as failed, the job itself only fails when the table cannot be read
+    Input: payload with the workspace
+    Output: Job result shown by the success page, with the succeeded, failed, updated, unchanged and duplicates counts
+    (None when not applicable)
+    """
+    workspace = payload['workspace']
+    df = load_table(workspace)
+    total_rows = max(int(df.shape[0]), 1)
+    storage = worker_storage()
+    succeeded, failed, updated, unchanged, duplicates = 0, 0, None, None, None
+    progress = 0
+
+    try:
+        logging.info("Loading transactions into the {} database".format(storage.dialect))
+        start = time.time()
+        if db_load_mode == 'upsert':
+            # Rows are staged in chunks then merged in one statement, re-imported rows are updated or left unchanged
+            for processed, counts in storage.upsert_transactions(df):
+                if counts is None:
+                    done = int(100 * processed / (total_rows + 1))
+                else:
+                    succeeded, updated, unchanged, duplicates = counts
+                    done = 99
+                if done > progress:
+                    progress = done
+                    jobs.set_progress(job_id, progress)
+        else:
+            # Rows are inserted and committed in chunks, progress is reported after each chunk
+            for processed, succeeded, failed in storage.insert_transactions(df):
+                if min(int(100 * processed / total_rows), 99) > progress:
+                    progress = min(int(100 * processed / total_rows), 99)
+                    jobs.set_progress(job_id, progress)
+        observe('bsa_db_load_rows_per_second', df.shape[0] / max(time.time() - start, 1e-6),
+                backend=storage.dialect, mode=db_load_mode)
+    except Exception as e:
+        logging.critical("Error occurred while inserting transactions : {}".format(str(e)))
+        if db_load_mode == 'upsert':
+            # The merge is rolled back as a whole
+            succeeded, failed, updated, unchanged, duplicates = 0, int(df.shape[0]), None, None, None
+
+    logging.info("{} successful transactions.".format(str(succeeded)))
+    logging.info("{} failed transactions.".format(str(failed)))
+
+    # New and corrected categories are learnt in the background, workers pick up the new model version
+    if retrain_after_upload and (succeeded or updated):
+        jobs.submit('retrain', {})
+
+    # The success page shows the counts of the job result
+    return {'succeeded': succeeded, 'failed': failed, 'updated': updated, 'unchanged': unchanged, 'duplicates': duplicates}
+
+def retrain_model(jobs, job_id, payload, cache):
+    """
+    Update the category model with the new and corrected transactions of the store
+    Output: Job result, with the new model version (None if the model was up to date or the new version was not published)
+    """
+    version = retrain(ML_FOLDER, worker_storage(), payload.get('full', False))
+    # The new transactions are merchants too
+    merchants.invalidate()
+    return {'version': version}
+
+# Job kinds submitted by the web app, and their handlers
+handlers = {
+    'statements': process_statements,
+    'load': load_transactions,
+    'retrain': retrain_model,
+}
+
+def run_worker():
+    """
+    Claim and run jobs until the process is stopped, sleeping while the queue is empty
+    """
+    jobs = JobQueue(job_database)
+    cache = OCRCache(CACHE_FOLDER + "ocr_cache.db", ocr_cache_max_bytes)
+    # Loaded before the first job, the memory mapped model pages are shared with the other workers
+    get_registry(ML_FOLDER).get()
+    logging.info("Job worker {} started".format(os.getpid()))
+
+    while True:
+        job = jobs.claim(job_stale_after)
+        if job is None:
+            time.sleep(job_poll_interval)
+            continue
+
+        job_id, kind, payload = job
+        logging.info("Job {} ({}) started by worker {}".format(job_id, kind, os.getpid()))
+        profiler = start_profile() if profile_jobs else None
+        start = time.time()
+        try:
+            jobs.finish(job_id, handlers[kind](jobs, job_id, payload, cache))
+            status = DONE
+        except Exception as e:
+            jobs.fail(job_id, e)
+            status = FAILED
+        observe('bsa_job_seconds', time.time() - start, kind=kind, status=status)
+        flush_metrics()
+        if profiler is not None:
+            save_profile(profiler, PROFILE_FOLDER, "{}_{}".format(kind, job_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the background job workers of the app")
+    parser.add_argument("-w", "--workers", type=int, default=job_workers, help="Number of job worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='logfile.txt', level = logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+    logging.getLogger('PIL.PngImagePlugin').setLevel(logging.WARNING)
+
+    # Not daemonic, each worker starts its own OCR process pool
+    processes = [multiprocessing.Process(target=run_worker) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,67 @@
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+# Upload workspaces: one directory per upload, owned by the user who created it
+# Kept apart from functions.py so that the web app can use them without importing pandas or the OCR stack
+
+
+def allowed_file(filename):
+    """
+    Check that uploaded files are either pdf, xlsx or zip (batch of pdf statements)
+    """
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in set(['pdf', 'xlsx', 'zip'])
+
+# Name of the file recording the user a workspace belongs to
+WORKSPACE_OWNER = ".owner"
+
+def create_workspace(UPLOAD_FOLDER, owner):
+    """
+    Create the working directory of a new upload, so that concurrent uploads never share files
+    Output: (workspace id, workspace path)
+    """
+    workspace_id = uuid.uuid4().hex
+    workspace = os.path.join(UPLOAD_FOLDER, workspace_id) + "/"
+    os.makedirs(workspace)
+    with open(workspace + WORKSPACE_OWNER, "w") as f:
+        f.write(str(owner))
+    return workspace_id, workspace
+
+def get_workspace(UPLOAD_FOLDER, workspace_id, owner):
+    """
+    Output: Path of the workspace, None if it does not exist, has expired or belongs to another user
+    """
+    if not re.match('^[0-9a-f]{32}$', workspace_id):
+        return None
+    workspace = os.path.join(UPLOAD_FOLDER, workspace_id) + "/"
+    try:
+        with open(workspace + WORKSPACE_OWNER) as f:
+            if f.read() != str(owner):
+                return None
+        # Workspaces in use are kept alive
+        os.utime(workspace, None)
+    except (IOError, OSError):
+        return None
+    return workspace
+
+def clean_workspaces(UPLOAD_FOLDER, ttl):
+    """
+    Delete the workspaces that have not been used for ttl seconds
+    """
+    if not os.path.isdir(UPLOAD_FOLDER):
+        return
+    now = time.time()
+    for workspace_id in os.listdir(UPLOAD_FOLDER):
+        path = os.path.join(UPLOAD_FOLDER, workspace_id)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                logging.info("Expired workspace {} deleted".format(workspace_id))
+        except OSError as e:
+            logging.debug("Error when deleting workspace {}: {}".format(workspace_id, str(e)))
@@ -9,12 +9,21 @@ def subprocess_cmd(command):
     proc_stdout = process.communicate()[0].strip()
     print (proc_stdout.decode("utf-8"))
 
+def start_workers():
+    # Background job workers processing the uploaded pdf files, left running alongside gunicorn
+    print ('starting job workers')
+    subprocess.Popen('python3 worker.py', shell=True)
+    return
+
 def start_server():
+    # Pdf processing runs in the job workers, requests no longer need a long timeout
+    # gevent workers keep the progress streams of the upload pages open without blocking other requests
     subprocess_cmd(
-            'gunicorn --timeout 600 --workers=3 --bind=0.0.0.0:5000 app:app'
+            'gunicorn --timeout 120 --workers=3 --worker-class gevent --worker-connections 1000 --bind=0.0.0.0:5000 app:app'
             )
     return
 
 subprocess_cmd('python --version')
 subprocess_cmd('pip --version')
+start_workers()
 start_server()